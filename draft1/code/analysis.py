@@ -6,8 +6,9 @@ from copy import copy
 from collections import defaultdict
 from itertools import product
 import numpy as np
-from scipy.stats import spearmanr, pearsonr
 from utils import *
+from metrics import fit_metrics, METRICS
+import bootstrap
 
 ######################################################################
 
@@ -29,33 +30,75 @@ class Analysis:
         self.rescale_experiment()        
 
     def rescale_experiment(self):
-        self.expmat = rownorm(self.expmat-1.0)
+        self.expmat = self.rescale(self.expmat)
+
+    def rescale(self, mat):
+        # Also applies to stacks of matrices:
+        return rownorm(mat-1.0)
         
+    def overall_metrics(self):
+        """Record array of the fit of each listener (in the order of
+        self.modnames) to self.expmat over all the cells; see metrics.fit_metrics."""
+        nmod = len(self.listeners)
+        return fit_metrics(self.expmat.reshape((1, -1)), np.array(self.listeners).reshape((nmod, -1)))
+
+    def metrics_by_message(self):
+        """Record array, indexed by (message, listener), of the fit of each
+        listener's row for each message to that row of self.expmat."""
+        return fit_metrics(self.expmat, np.array(self.listeners)).T
+    
     def overall_analysis(self, digits=4):
-        expvec = self.expmat.flatten()
-        rows = []
-        for i, lis in enumerate(self.listeners):
-            lisvec = lis.flatten()
-            pearson, pearson_p = pearsonr(expvec, lisvec)
-            spearman, spearman_p = spearmanr(expvec, lisvec)
-            err = mse(expvec, lisvec)            
-            rows.append(np.array([pearson, pearson_p, spearman, spearman_p, err]))        
-        display_matrix(np.array(rows), rnames=self.modnames, cnames=['Pearson', 'Pearson p', 'Spearman', 'Spearman p', 'MSE'], digits=digits)
+        results = self.overall_metrics()
+        display_matrix(self.metrics2matrix(results), rnames=self.modnames, cnames=['Pearson', 'Pearson p', 'Spearman', 'Spearman p', 'MSE'], digits=digits)
+        return results
 	
     def analysis_by_message(self, digits=4):
-        rows = []
         msglen = max([len(x) for x in self.messages])
         modlen = max([len(x) for x in self.modnames])
         rnames = [msg.rjust(msglen)+" "+ mod.rjust(modlen) for msg, mod in product(self.messages, self.modnames)]
-        for i, msg in enumerate(self.messages):        
-            expvec = self.expmat[i]
-            for j, lis in enumerate(self.listeners):
-                lisvec = lis[i]
-                pearson, pearson_p = pearsonr(expvec, lisvec)
-                spearman, spearman_p = spearmanr(expvec, lisvec)
-                err = mse(expvec, lisvec)            
-                rows.append(np.array([pearson, pearson_p, spearman, spearman_p, err]))        
-        display_matrix(np.array(rows), rnames=rnames, cnames=['Pearson', 'Pearson p', 'Spearman', 'Spearman p', 'MSE'], digits=digits)
+        results = self.metrics_by_message()
+        display_matrix(self.metrics2matrix(results.ravel()), rnames=rnames, cnames=['Pearson', 'Pearson p', 'Spearman', 'Spearman p', 'MSE'], digits=digits)
+        return results
+
+    def metrics2matrix(self, results):
+        return np.array([results[name] for name in METRICS]).T
+
+    def bootstrap_metrics(self, metrics=('pearson', 'spearman', 'mse'), n_samples=1000, alpha=0.05, method='bca', seed=None, chunk_size=100):
+        """Confidence intervals for the fit of each listener, and for the
+        difference in fit between each pair of listeners, from a bootstrap
+        over the experiment's subjects; the experiment must be a
+        ColumnarExperiment. Each resample recomputes self.expmat from the
+        resampled subjects' responses and every fit statistic from it.
+        Returns a record array with a row per comparison (a model name, or
+        'A - B') and metric, giving the estimate and the low and high
+        ends of the interval."""
+        sums, counts = self.experiment.subject_cell_stats()
+        cells = self.experiment.cell_indices(self.messages, self.worlds)
+        listeners = np.array(self.listeners)
+        pairs = [(i, j) for i in range(len(self.modnames)) for j in range(i+1, len(self.modnames))]
+        def fits(cell_means):
+            # (samples, cells) cell means to (samples, metrics * (listeners + pairs)) statistics:
+            expmats = self.rescale(cell_means[:, cells]).reshape((len(cell_means), 1, -1))
+            results = fit_metrics(expmats, listeners.reshape((len(listeners), -1)))
+            values = np.array([results[name] for name in metrics]).transpose((1, 0, 2))
+            diffs = np.array([values[:, :, i] - values[:, :, j] for i, j in pairs]).transpose((1, 2, 0))
+            return np.concatenate((values, diffs), axis=2).reshape((len(cell_means), -1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ostat = fits((np.sum(sums, axis=0) / np.sum(counts, axis=0))[np.newaxis])[0]
+            stat = np.concatenate([fits(np.dot(W, sums) / np.dot(W, counts))
+                                   for W in bootstrap.bootstrap_weight_chunks(len(sums), n_samples, chunk_size, seed)])
+            jstat = fits((np.sum(sums, axis=0) - sums) / (np.sum(counts, axis=0) - counts)) if method == 'bca' else None
+        intervals = bootstrap.stat_intervals(stat, ostat, jstat, np.array([alpha/2, 1-alpha/2]), method)
+        comparisons = self.modnames + ["%s - %s" % (self.modnames[i], self.modnames[j]) for i, j in pairs]
+        rows = [(comparison, metric) for metric in metrics for comparison in comparisons]
+        return np.rec.fromrecords([(comparison, metric, est, low, high) for (comparison, metric), est, (low, high) in zip(rows, ostat, intervals)],
+                                  names=('comparison', 'metric', 'estimate', 'low', 'high'))
+
+    def bootstrap_analysis(self, digits=4, **kwargs):
+        results = self.bootstrap_metrics(**kwargs)
+        rnames = ["%s %s" % (metric, comparison) for comparison, metric in zip(results.comparison, results.metric)]
+        display_matrix(np.array([results.estimate, results.low, results.high]).T, rnames=rnames, cnames=['Estimate', 'Low', 'High'], digits=digits)
+        return results
 
     def comparison_plot(self, width=0.2, output_filename=None):
         # Preferred: human left, then models from best to worse, informally:
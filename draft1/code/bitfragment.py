@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# Compact counterpart of fragment.py with the same interface, so that it
+# can be given to UncertaintyGrammars as its semantics. Entities are bit
+# positions and sets of entities are integer masks. Quantifiers are boolean
+# arrays indexed by mask, determiners boolean matrices indexed by pairs of
+# masks. Intensional properties and relations are arrays of masks indexed
+# by world (in the order given to define_lexicon), and propositions are
+# boolean vectors over the worlds.
+
+from itertools import product
+import numpy as np
+from fragment import a, b, c, s1, s2, get_worlds, worldname
+from utils import powerset
+
+######################################################################
+
+def define_lexicon(player=[], shot=[], worlds=[]):
+    entities = player + shot
+    masks = np.arange(2**len(entities))
+    card = popcounts(len(entities))
+    P = entity_mask(player, entities)
+    S = entity_mask(shot, entities)
+    A = entity_mask([a], entities)
+    B = entity_mask([b], entities)
+    C = entity_mask([c], entities)
+    def within(X, Y):
+        return (X & ~Y) == 0
+    def shots_hit(w, x):
+        return entity_mask(shot[: w[player.index(x)]], entities)
+    def intensional(cond):
+        return np.array([entity_mask([x for x in player if cond(len(shot[: w[player.index(x)]]))], entities) for w in worlds])
+    X = masks[:, np.newaxis]
+    Y = masks[np.newaxis, :]
+    lex = {
+        # Concessions to tractability -- these are defined extensionally (invariant across worlds):
+        "some":        card[X & Y] > 0,
+        "exactly_one": card[X & Y] == 1,
+        "every":       within(X, Y),
+        "no":          card[X & Y] == 0,
+        "PlayerA":     within(masks, P) & ((masks & A) > 0),
+        "PlayerB":     within(masks, P) & ((masks & B) > 0),
+        "PlayerC":     within(masks, P) & ((masks & C) > 0),
+        # Extensional, as in fragment.py:
+        "player":      P,
+        "shot":        S,
+        # Intensional predicates:
+        "scored":      intensional(lambda hits : hits > 0),
+        "aced":        intensional(lambda hits : hits > 1),
+        "missed":      intensional(lambda hits : hits == 0),
+        "hit" :        np.array([[shots_hit(w, x) if x in player else 0 for x in entities] for w in worlds]),
+        # What we refine rather than the determiners (see fragment.py):
+        "some_player":        within(masks, P) & (card[masks & P] > 0),
+        "some_shot":          within(masks, S) & (card[masks & S] > 0),
+        "exactly_one_player": within(masks, P) & (card[masks & P] == 1),
+        "exactly_one_shot":   card[masks & S] == 1,
+        "every_player":       within(P, masks),
+        "every_shot":         within(S, masks),
+        "no_player":          card[masks & P] == 0,
+        "no_shot":            card[masks & S] == 0,
+        # Mainly for specifying refinements:
+        "not_every_player":   ~within(P, masks),
+        "not_every_shot":     ~within(S, masks),
+        "scored_not_aced":    intensional(lambda hits : hits == 1),
+        "only_PlayerA":       within(masks, P) & (masks == A) & (A > 0),
+        "only_PlayerB":       within(masks, P) & (masks == B) & (B > 0),
+        "only_PlayerC":       within(masks, P) & (masks == C) & (C > 0)
+        }
+    return lex
+
+def entity_mask(X, entities):
+    """The mask for the set of entities X; entities outside the domain are ignored."""
+    return sum(1 << entities.index(x) for x in set(X) if x in entities)
+
+def bits(mask):
+    """The positions of the bits set in mask, in increasing order."""
+    return [i for i in range(int(mask).bit_length()) if (mask >> i) & 1]
+
+def popcounts(n):
+    """Array giving the cardinality of each of the 2**n masks over n entities."""
+    card = np.zeros(2**n, dtype=int)
+    for i in range(n):
+        card[2**i: 2**(i+1)] = card[: 2**i] + 1
+    return card
+
+######################################################################
+
+def fa(A, b):
+    """Function application is just indexing: a determiner applied to a
+    mask gives a quantifier, and a property applied to a world index
+    gives a mask."""
+    return A[b]
+
+def iv(Q, X):
+    """Returns a proposition as the boolean vector over worlds that is true
+    at w iff the set of entities X-at-w is a member of the quantifier Q."""
+    return Q[X]
+
+def tv(V, Q, worlds, subjects):
+    """Combines the intensional relation V (world by entity array of
+    object masks) with the quantifier Q to give the intensional property
+    true of x at w iff the set of things x Vs at w is in Q."""
+    positions = bits(subjects)
+    return np.dot(tv_matrix(V, Q, worlds, subjects), np.array([1 << i for i in positions], dtype=int)).astype(int)
+
+def tv_matrix(V, Q, worlds, subjects):
+    """The property tv(V, Q, worlds, subjects) as a boolean world by subject
+    array, with the subjects in increasing bit order."""
+    return Q[V[:, bits(subjects)]]
+
+######################################################################
+
+def refinements(semval):
+    """All the non-empty subsets of the denotation semval, in the same
+    representation. The members are the set bits of a mask, the true cells
+    of a boolean array, and the (cell, bit) pairs of an array of masks."""
+    if isinstance(semval, np.ndarray) and semval.dtype == bool:
+        refined = []
+        for members in powerset(list(np.flatnonzero(semval)), minsize=1):
+            val = np.zeros(semval.shape, dtype=bool)
+            val.flat[members] = True
+            refined.append(val)
+        return refined
+    elif isinstance(semval, np.ndarray):
+        refined = []
+        members = [(i, bit) for i in np.flatnonzero(semval) for bit in bits(semval.flat[i])]
+        for subset in powerset(members, minsize=1):
+            val = np.zeros_like(semval)
+            for i, bit in subset:
+                val.flat[i] |= 1 << bit
+            refined.append(val)
+        return refined
+    else:
+        return [sum(1 << bit for bit in subset) for subset in powerset(bits(semval), minsize=1)]
+
+def random_refinement(semval, random_state):
+    """A uniform draw from refinements(semval) without listing them: each
+    member is kept with probability 1/2, and empty draws are redrawn."""
+    if isinstance(semval, np.ndarray) and semval.dtype == bool:
+        members = list(np.flatnonzero(semval))
+    elif isinstance(semval, np.ndarray):
+        members = [(i, bit) for i in np.flatnonzero(semval) for bit in bits(semval.flat[i])]
+    else:
+        members = bits(semval)
+    if not members:
+        raise ValueError("An empty denotation has no non-empty refinements")
+    keep = np.zeros(len(members), dtype=bool)
+    while not keep.any():
+        keep = random_state.rand(len(members)) < 0.5
+    subset = [x for x, kept in zip(members, keep) if kept]
+    if isinstance(semval, np.ndarray) and semval.dtype == bool:
+        val = np.zeros(semval.shape, dtype=bool)
+        val.flat[subset] = True
+        return val
+    elif isinstance(semval, np.ndarray):
+        val = np.zeros_like(semval)
+        for i, bit in subset:
+            val.flat[i] |= 1 << bit
+        return val
+    return sum(1 << bit for bit in subset)
+
+######################################################################
+
+if __name__ == '__main__':
+
+    # Domain set up:
+    player = [a, b, c]
+    shot = [s1, s2]
+    worlds = get_worlds((0,1,2), length=len(player), increasing=True)
+    lex = define_lexicon(player=player, shot=shot, worlds=worlds)
+
+    # Examples:
+    for d1, d2 in product(("some", "exactly_one", "every", "no"), repeat=2):
+        msg = "%s(player)(hit(%s(shot)))" % (d1, d2)
+        prop = iv(fa(lex[d1], lex["player"]), tv(lex["hit"], fa(lex[d2], lex["shot"]), worlds, lex["player"]))
+        print msg, [worldname(w) for w, val in zip(worlds, prop) if val]
+
+    # Examples:
+    for pn, pred in product(('PlayerA', 'PlayerB', 'PlayerC'), ("missed", "scored", "aced")):
+        msg = "%s(%s)" % (pn, pred)
+        prop = iv(lex[pn], lex[pred])
+        print msg, [worldname(w) for w, val in zip(worlds, prop) if val]
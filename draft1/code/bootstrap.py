@@ -1,6 +1,7 @@
 from numpy.random import randint
 from scipy.stats import norm
 import numpy as np
+import multiprocessing
 import warnings
 
 class InstabilityWarning(UserWarning):
@@ -10,7 +11,20 @@ class InstabilityWarning(UserWarning):
 # On import, make sure that InstabilityWarnings are not filtered out.
 warnings.simplefilter('always',InstabilityWarning)
 
-def ci(data, statfunction=np.average, alpha=0.05, n_samples=10000, method='bca', output='lowhigh', epsilon=0.001, multi=None):
+# The statistic function and data for the workers of a process pool, which
+# inherit them when they are forked instead of having them pickled:
+_pool_job = None
+
+def _pool_chunk_stats(chunk):
+    statfunction, tdata = _pool_job
+    return chunk_stats(statfunction, tdata, *chunk)
+
+def _pool_jackknife_stat(i):
+    statfunction, tdata = _pool_job
+    indexes = np.delete(np.arange(tdata[0].shape[0]), i)
+    return statfunction(*(x[indexes] for x in tdata))
+
+def ci(data, statfunction=np.average, alpha=0.05, n_samples=10000, method='bca', output='lowhigh', epsilon=0.001, multi=None, chunk_size=1000, seed=None, processes=None):
     """
 Given a set of data ``data``, and a statistics function ``statfunction`` that
 applies to that data, computes the bootstrap confidence interval for
@@ -33,7 +47,11 @@ statfunction: function (data, weights=(weights, optional)) -> value
     If using the ABC method, the function _must_ accept a named ``weights`` 
     parameter which will be an array_like with weights for each sample, and 
     must return a _weighted_ result. Otherwise this parameter is not used
-    or required. Note that numpy's np.average accepts this. (default=np.average)
+    or required. Note that numpy's np.average accepts this. If the function
+    also accepts a 2-D array of weights, one weighting per row, and returns
+    one value per row, all the weightings ABC needs are evaluated in a single
+    call; np.average on 1-D data is vectorized this way automatically.
+    (default=np.average)
 alpha: float or iterable, optional
     The percentiles to use for the confidence interval (default=0.05). If this
     is a float, the returned values are (alpha/2, 1-alpha/2) percentile confidence
@@ -54,6 +72,21 @@ multi: boolean, optional
     If False, assume data is a single array. If True, assume data is a tuple/other
     iterable of arrays of the same length that should be sampled together. If None,
     decide based on whether the data is an actual tuple. (default=None)
+chunk_size: int, optional
+    The number of bootstrap samples whose indexes are generated at a time, which
+    bounds the memory used for indexes independently of n_samples. The results
+    don't depend on it unless a seed or processes is given, in which case it
+    fixes the chunks that the random streams are tied to. (default=1000)
+seed: int, optional
+    If given, the global random state is left alone, and bootstrap chunk k
+    draws its indexes from its own RandomState([seed, k]), so the interval is
+    reproducible for the seed and independent of processes. (default=None)
+processes: int, optional
+    If given, the bootstrap chunks and the jackknife are evaluated on a
+    pool of this many processes, which is worthwhile for expensive
+    statfunctions. The statistics are gathered in chunk order, so the result
+    is the same for any number of processes; without a seed, the seed is drawn
+    from the global random state. (default=None)
     
 Returns
 -------
@@ -124,33 +157,34 @@ Efron, An Introduction to the Bootstrap. Chapman & Hall 1993
         ep = epsilon / n*1.0
         p0 = np.repeat(1.0/n,nn)
 
-        t1 = np.zeros(nn); t2 = np.zeros(nn)
+        if statfunction is np.average and multi == False and data.ndim == 1:
+          # The weighted mean of every row of weights at once:
+          weighted = lambda weights: np.dot(weights, data)/np.sum(weights, axis=-1)
+        else:
+          weighted = lambda weights: statfunction(*tdata,weights=weights)
+
         try:
-          t0 = statfunction(*tdata,weights=p0)
+          t0 = weighted(p0)
         except TypeError as e:
           raise TypeError("statfunction does not accept correct arguments for ABC ({0})".format(e.message))
 
-        # There MUST be a better way to do this!
-        for i in range(0,nn):
-            di = I[i] - p0
-            tp = statfunction(*tdata,weights=p0+ep*di)
-            tm = statfunction(*tdata,weights=p0-ep*di)
-            t1[i] = (tp-tm)/(2*ep)
-            t2[i] = (tp-2*t0+tm)/ep**2
+        # All 2n perturbed weightings are evaluated together:
+        D = I - p0
+        tp, tm = np.split(weightings(weighted, np.concatenate((p0+ep*D, p0-ep*D))), 2)
+        t1 = (tp-tm)/(2*ep)
+        t2 = (tp-2*t0+tm)/ep**2
 
         sighat = np.sqrt(np.sum(t1**2))/n
         a = (np.sum(t1**3))/(6*n**3*sighat**3)
         delta = t1/(n**2*sighat)
-        cq = (statfunction(*tdata,weights=p0+ep*delta)-2*t0+statfunction(*tdata,weights=p0-ep*delta))/(2*sighat*ep**2)
+        cq = (np.sum(weightings(weighted, np.array([p0+ep*delta, p0-ep*delta])))-2*t0)/(2*sighat*ep**2)
         bhat = np.sum(t2)/(2*n**2)
         curv = bhat/sighat-cq
         z0 = norm.ppf(2*norm.cdf(a)*norm.cdf(-curv))
         Z = z0+norm.ppf(alphas)
         za = Z/(1-a*Z)**2
         # stan = t0 + sighat * norm.ppf(alphas)
-        abc = np.zeros_like(alphas)
-        for i in range(0,len(alphas)):
-            abc[i] = statfunction(*tdata,weights=p0+za[i]*delta)
+        abc = weightings(weighted, p0+za[:,np.newaxis]*delta)
 
         if output == 'lowhigh':
             return abc
@@ -159,11 +193,7 @@ Efron, An Introduction to the Bootstrap. Chapman & Hall 1993
         else:
             raise ValueError("Output option {0} is not supported.".format(output))
 
-    # We don't need to generate actual samples; that would take more memory.
-    # Instead, we can generate just the indexes, and then apply the statfun
-    # to those indexes.
-    bootindexes = bootstrap_indexes( tdata[0], n_samples )
-    stat = np.array([statfunction(*(x[indexes] for x in tdata)) for indexes in bootindexes])
+    stat, jstat = resample_stats(statfunction, tdata, n_samples, chunk_size, seed, processes, jackknife=(method == 'bca'))
     stat.sort(axis=0)
 
     # Percentile Interval Method
@@ -180,8 +210,6 @@ Efron, An Introduction to the Bootstrap. Chapman & Hall 1993
         z0 = norm.ppf( ( 1.0*np.sum(stat < ostat, axis=0)  ) / n_samples )
 
         # Statistics of the jackknife distribution
-        jackindexes = jackknife_indexes(tdata[0])
-        jstat = [statfunction(*(x[indexes] for x in tdata)) for indexes in jackindexes]
         jmean = np.mean(jstat,axis=0)
 
         # Acceleration value
@@ -222,6 +250,57 @@ Efron, An Introduction to the Bootstrap. Chapman & Hall 1993
 
 
 
+def resample_stats(statfunction, tdata, n_samples=10000, chunk_size=1000, seed=None, processes=None, jackknife=True):
+    """
+Given a tuple of data arrays ``tdata``, returns the array of ``statfunction``
+on n_samples bootstrap samples, in the order they are drawn, and the array of
+its jackknife statistics (None unless ``jackknife``). seed, processes and
+chunk_size are as for ``ci``.
+    """
+    global _pool_job
+    pool = None
+    if processes is not None:
+        _pool_job = (statfunction, tdata)
+        pool = multiprocessing.Pool(processes)
+        if seed is None:
+            seed = randint(2**31)
+    try:
+        if seed is None:
+            # We don't need to generate actual samples; that would take more
+            # memory. Instead, we can generate just the indexes, a chunk at a
+            # time, and then apply the statfun to those indexes.
+            bootchunks = bootstrap_index_chunks( tdata[0], n_samples, chunk_size )
+            stat = np.array([statfunction(*(x[indexes] for x in tdata)) for bootindexes in bootchunks for indexes in bootindexes])
+        else:
+            chunks = [(seed, k, min(chunk_size, n_samples-start)) for k, start in enumerate(range(0, n_samples, chunk_size))]
+            if pool is None:
+                stats = [chunk_stats(statfunction, tdata, *chunk) for chunk in chunks]
+            else:
+                stats = pool.map(_pool_chunk_stats, chunks)
+            stat = np.concatenate(stats)
+        jstat = None
+        if jackknife and pool is None:
+            jackindexes = jackknife_indexes(tdata[0])
+            jstat = np.array([statfunction(*(x[indexes] for x in tdata)) for indexes in jackindexes])
+        elif jackknife:
+            jstat = np.array(pool.map(_pool_jackknife_stat, range(tdata[0].shape[0])))
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            _pool_job = None
+    return stat, jstat
+
+def chunk_stats(statfunction, tdata, seed, k, size):
+    """
+Returns the array of ``statfunction`` on the ``size`` bootstrap samples of
+chunk ``k``, whose indexes are drawn from RandomState([seed, k]).
+    """
+    N = tdata[0].shape[0]
+    bootindexes = np.random.RandomState([seed, k]).randint(N, size=(size, N))
+    return np.array([statfunction(*(x[indexes] for x in tdata)) for indexes in bootindexes])
+
 def ci_abc(data, stat=lambda x,y: np.average(x,weights=y), alpha=0.05, epsilon = 0.001):
     """
 .. note:: Deprecated. This functionality is now rolled into ci.
@@ -240,6 +319,8 @@ data: array_like, shape (N, ...)
 stat: function (data, weights) -> value
     The _weighted_ statistic function. This must accept weights, unlike for other
     methods.
+    If it also accepts a 2-D array of weights, one weighting per row, and returns
+    one value per row, it is evaluated on all the perturbed weightings at once.
 alpha: float or iterable, optional
     The percentiles to use for the confidence interval (default=0.05). If this
     is a float, the returned values are (alpha/2, 1-alpha/2) percentile confidence
@@ -275,33 +356,241 @@ bootstrap R package: http://cran.r-project.org/web/packages/bootstrap/
     ep = epsilon / n*1.0
     p0 = np.repeat(1.0/n,nn)
 
-    t1 = np.zeros(nn); t2 = np.zeros(nn)
-    t0 = stat(data,p0)
+    weighted = lambda weights: stat(data,weights)
+    t0 = weighted(p0)
 
-    # There MUST be a better way to do this!
-    for i in range(0,nn):
-        di = I[i] - p0
-        tp = stat(data,p0+ep*di)
-        tm = stat(data,p0-ep*di)
-        t1[i] = (tp-tm)/(2*ep)
-        t2[i] = (tp-2*t0+tm)/ep**2
+    # All 2n perturbed weightings are evaluated together:
+    D = I - p0
+    tp, tm = np.split(weightings(weighted, np.concatenate((p0+ep*D, p0-ep*D))), 2)
+    t1 = (tp-tm)/(2*ep)
+    t2 = (tp-2*t0+tm)/ep**2
 
     sighat = np.sqrt(np.sum(t1**2))/n
     a = (np.sum(t1**3))/(6*n**3*sighat**3)
     delta = t1/(n**2*sighat)
-    cq = (stat(data,p0+ep*delta)-2*t0+stat(data,p0-ep*delta))/(2*sighat*ep**2)
+    cq = (np.sum(weightings(weighted, np.array([p0+ep*delta, p0-ep*delta])))-2*t0)/(2*sighat*ep**2)
     bhat = np.sum(t2)/(2*n**2)
     curv = bhat/sighat-cq
     z0 = norm.ppf(2*norm.cdf(a)*norm.cdf(-curv))
     Z = z0+norm.ppf(alpha)
     za = Z/(1-a*Z)**2
     # stan = t0 + sighat * norm.ppf(alpha)
-    abc = np.zeros_like(alpha)
-    for i in range(0,len(alpha)):
-        abc[i] = stat(data,p0+za[i]*delta)
+    abc = weightings(weighted, p0+za[:,np.newaxis]*delta)
 
     return abc
 
+def ci_mean_batch(cells, alpha=0.05, n_samples=10000, method='bca', output='lowhigh', chunk_size=1000):
+    """
+Given a collection of samples ``cells``, possibly of different sizes, computes
+bootstrap confidence intervals for the mean of every sample at once. This is
+equivalent to calling ``ci(cell, np.average, ...)`` on each cell in turn, and
+draws the same bootstrap indexes from the global random state in the same
+order, but the resample means are taken with one vectorized reduction per cell,
+the jackknife uses the closed form for the mean, and the bias correction,
+acceleration and percentiles are computed for all cells together. Cells whose
+values are all identical get the degenerate interval (value, value) without
+any sampling.
+
+Parameters
+----------
+cells: sequence of array_like, each of shape (N_i,)
+    The samples. Empty cells are not allowed.
+alpha: float or iterable, optional
+    As for ``ci`` (default=0.05).
+n_samples: float, optional
+    The number of bootstrap samples to use for each cell (default=10000)
+method: string, optional
+    The method to use: one of 'pi' or 'bca' (default='bca')
+output: string, optional
+    'lowhigh' or 'errorbar', as for ``ci`` (default='lowhigh')
+chunk_size: int, optional
+    As for ``ci`` (default=1000)
+
+Returns
+-------
+confidences: array, shape (len(cells), len(alphas))
+    The confidence percentiles specified by alpha for each cell, one row
+    per cell.
+    """
+    if np.iterable(alpha):
+        alphas = np.array(alpha)
+    else:
+        alphas = np.array([alpha/2,1-alpha/2])
+
+    cells = [np.array(cell, dtype=float) for cell in cells]
+    sizes = np.array([len(cell) for cell in cells])
+    means = np.array([np.average(cell) for cell in cells])
+    constant = np.array([np.all(cell == cell[0]) for cell in cells])
+    varying = np.flatnonzero(~constant)
+
+    # Resample means, one column per non-constant cell:
+    stat = np.zeros((n_samples, len(varying)))
+    for j, i in enumerate(varying):
+        start = 0
+        for bootindexes in bootstrap_index_chunks(cells[i], n_samples, chunk_size):
+            stat[start: start+len(bootindexes), j] = np.mean(cells[i][bootindexes], axis=1)
+            start += len(bootindexes)
+    stat.sort(axis=0)
+
+    if method == 'pi':
+        nvals = np.round((n_samples-1)*alphas).astype('int')
+        nvals = np.tile(nvals.reshape(alphas.shape+(1,)), (1, len(varying)))
+    elif method == 'bca':
+        # Closed-form jackknife for the mean: the deviations of the
+        # jackknife means from their average are (x_i - mean)/(N-1), and
+        # the (N-1) factors cancel in the acceleration.
+        cellids = np.repeat(np.arange(len(cells)), sizes)
+        deviations = np.concatenate(cells) - means[cellids]
+        skew = np.bincount(cellids, weights=deviations**3, minlength=len(cells))
+        spread = np.bincount(cellids, weights=deviations**2, minlength=len(cells))
+        a = skew[varying] / ( 6.0 * spread[varying]**1.5 )
+        nvals = bca_indexes(stat, means[varying], a, alphas)
+    else:
+        raise ValueError("Method {0} is not supported.".format(method))
+
+    if np.any(nvals==0) or np.any(nvals==n_samples-1):
+        warnings.warn("Some values used extremal samples; results are probably unstable.", InstabilityWarning)
+    elif np.any(nvals<10) or np.any(nvals>=n_samples-10):
+        warnings.warn("Some values used top 10 low/high samples; results may be unstable.", InstabilityWarning)
+
+    intervals = np.tile(means.reshape((len(cells), 1)), (1, len(alphas)))
+    intervals[varying] = stat[(nvals, np.arange(len(varying)))].T
+
+    if output == 'lowhigh':
+        return intervals
+    elif output == 'errorbar':
+        return abs(means.reshape((len(cells), 1))-intervals)
+    else:
+        raise ValueError("Output option {0} is not supported.".format(output))
+
+def ci_cluster_means(sums, counts, alpha=0.05, n_samples=10000, method='bca', output='lowhigh', chunk_size=1000, seed=None):
+    """
+Given the sums ``sums`` and counts ``counts`` of the observations that each
+of S clusters (e.g. subjects) contributes to each of K cells, computes cluster
+bootstrap confidence intervals for the means of all K cells at once. Whole
+clusters are resampled: each bootstrap sample is a vector of multinomial
+counts of the clusters, and the cell means of a chunk of samples are two
+matrix products, (W . sums) / (W . counts). The jackknife for BCa leaves out
+one cluster at a time. Cells whose observations are all identical get the
+degenerate interval (value, value), as in ``ci_mean_batch``.
+
+Parameters
+----------
+sums: array_like, shape (S, K)
+    The sum of each cluster's observations in each cell.
+counts: array_like, shape (S, K)
+    The number of each cluster's observations in each cell.
+alpha, n_samples, output, chunk_size, seed:
+    As for ``ci``.
+method: string, optional
+    The method to use: one of 'pi' or 'bca' (default='bca')
+
+Returns
+-------
+confidences: array, shape (K, len(alphas))
+    The confidence percentiles specified by alpha for each cell. They are nan
+    for cells left empty by some bootstrap sample, which only happens when
+    very few clusters contribute to a cell.
+    """
+    if np.iterable(alpha):
+        alphas = np.array(alpha)
+    else:
+        alphas = np.array([alpha/2,1-alpha/2])
+
+    sums = np.asarray(sums, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    S, K = sums.shape
+    # Empty cells come out nan, as in the resamples below:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.sum(sums, axis=0) / np.sum(counts, axis=0)
+
+    # Cluster resamples of the cell means, a chunk of samples at a time:
+    stat = np.zeros((n_samples, K))
+    start = 0
+    for W in bootstrap_weight_chunks(S, n_samples, chunk_size, seed):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stat[start: start+len(W)] = np.dot(W, sums) / np.dot(W, counts)
+        start += len(W)
+
+    # Leave-one-cluster-out means:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        jstat = (np.sum(sums, axis=0) - sums) / (np.sum(counts, axis=0) - counts)
+
+    intervals = stat_intervals(stat, means, jstat, alphas, method)
+
+    if output == 'lowhigh':
+        return intervals
+    elif output == 'errorbar':
+        return abs(means.reshape((K, 1))-intervals)
+    else:
+        raise ValueError("Output option {0} is not supported.".format(output))
+
+def stat_intervals(stat, ostat, jstat, alphas, method='bca'):
+    """
+Given the bootstrap statistics ``stat`` of shape (n_samples, K), which are
+sorted in place, the statistics ``ostat`` of shape (K,) on the original data,
+and the jackknife statistics ``jstat`` of shape (N, K) (only used by BCa),
+returns the (K, len(alphas)) array of 'pi' or 'bca' confidence percentiles
+``alphas`` for the K statistics. Statistics that are the same in every sample
+get (value, value), and those that are nan in any sample get nan.
+    """
+    n_samples, K = stat.shape
+    stat.sort(axis=0)
+    constant = np.all(stat == stat[0], axis=0)
+    varying = np.flatnonzero(~constant & ~np.any(np.isnan(stat), axis=0))
+
+    if method == 'pi':
+        nvals = np.round((n_samples-1)*alphas).astype('int')
+        nvals = np.tile(nvals.reshape(alphas.shape+(1,)), (1, len(varying)))
+    elif method == 'bca':
+        jmean = np.mean(jstat[:, varying], axis=0)
+        a = np.sum( (jmean - jstat[:, varying])**3, axis=0 ) / ( 6.0 * np.sum( (jmean - jstat[:, varying])**2, axis=0)**1.5 )
+        nvals = bca_indexes(stat[:, varying], ostat[varying], a, alphas)
+    else:
+        raise ValueError("Method {0} is not supported.".format(method))
+
+    if np.any(nvals==0) or np.any(nvals==n_samples-1):
+        warnings.warn("Some values used extremal samples; results are probably unstable.", InstabilityWarning)
+    elif np.any(nvals<10) or np.any(nvals>=n_samples-10):
+        warnings.warn("Some values used top 10 low/high samples; results may be unstable.", InstabilityWarning)
+
+    intervals = np.zeros((K, len(alphas))) + np.nan
+    intervals[constant] = stat[0, constant].reshape((-1, 1))
+    intervals[varying] = stat[:, varying][(nvals, np.arange(len(varying)))].T
+    return intervals
+
+def weightings(weighted, W):
+    """
+Given a weighted statistic ``weighted`` (a function of a weights vector only)
+and a 2-D array ``W`` with one weighting per row, returns the array of the
+statistic under each weighting. If ``weighted`` accepts the whole matrix and
+returns one value per row, as a weighted mean written as a matrix product
+does, it is called once; otherwise it is called row by row.
+    """
+    try:
+        values = np.asarray(weighted(W))
+        if values.shape == (W.shape[0],):
+            return values
+    except (TypeError, ValueError):
+        # A statistic that can't take the matrix fails on its shape (a
+        # TypeError from np.average, a ValueError from broadcasting), which
+        # just means the row-by-row route; anything else is a real error:
+        pass
+    return np.array([weighted(w) for w in W])
+
+def bca_indexes(stat, ostat, a, alphas):
+    """
+Given bootstrap statistics ``stat`` of shape (n_samples, K), sorted along axis
+0, the statistics ``ostat`` on the original data and the acceleration values
+``a``, both of shape (K,), returns the (len(alphas), K) array of indexes into
+``stat`` of the bias-corrected accelerated interval endpoints (Efron 14.3).
+    """
+    n_samples = stat.shape[0]
+    z0 = norm.ppf( ( 1.0*np.sum(stat < ostat, axis=0) ) / n_samples )
+    zs = z0 + norm.ppf(alphas).reshape(alphas.shape+(1,))
+    avals = norm.cdf(z0 + zs/(1-a*zs))
+    return np.round((n_samples-1)*avals).astype('int')
+
 def bootstrap_indexes(data, n_samples=10000):
     """
 Given data points data, where axis 0 is considered to delineate points, return
@@ -310,6 +599,28 @@ of bootstrap indexes as well.
     """
     return randint(data.shape[0],size=(n_samples,data.shape[0]) )
 
+def bootstrap_index_chunks(data, n_samples=10000, chunk_size=1000):
+    """
+Given data points data, where axis 0 is considered to delineate points, yield
+the bootstrap indexes of ``bootstrap_indexes`` as arrays of at most ``chunk_size``
+rows, so that only one chunk is in memory at a time. The indexes are drawn
+from the global random state in the same order, so the concatenated chunks
+are exactly ``bootstrap_indexes(data, n_samples)``.
+    """
+    for start in range(0, n_samples, chunk_size):
+        yield randint(data.shape[0],size=(min(chunk_size,n_samples-start),data.shape[0]) )
+
+def bootstrap_weight_chunks(n, n_samples=10000, chunk_size=1000, seed=None):
+    """
+Yields the bootstrap samples of n data points as multinomial counts, arrays of
+shape (at most chunk_size, n) whose rows say how often each point is drawn. They
+are drawn from the global random state, or, given a seed, chunk k from its own
+RandomState([seed, k]), as in ``ci``.
+    """
+    for k, start in enumerate(range(0, n_samples, chunk_size)):
+        rng = np.random if seed is None else np.random.RandomState([seed, k])
+        yield rng.multinomial(n, np.repeat(1.0/n, n), size=min(chunk_size, n_samples-start))
+
 def jackknife_indexes(data):
     """
 Given data points data, where axis 0 is considered to delineate points, return
@@ -321,7 +632,7 @@ Y with the ith data point deleted.
     base = np.arange(0,len(data))
     return (np.delete(base,i) for i in base)
 
-def subsample_indexes(data, n_samples=1000, size=0.5):
+def subsample_indexes(data, n_samples=1000, size=0.5, chunk_size=1000):
     """
 Given data points data, where axis 0 is considered to delineate points, return
 a list of arrays where each array is indexes a subsample of the data of size
@@ -329,16 +640,29 @@ a list of arrays where each array is indexes a subsample of the data of size
 size < 1, it will be taken to be a fraction of the data size. If size == -1, it
 will be taken to mean subsamples the same size as the sample (ie, permuted
 samples)
+    """
+    return np.concatenate(list(subsample_index_chunks(data, n_samples, size, chunk_size)))
+
+def subsample_index_chunks(data, n_samples=1000, size=0.5, chunk_size=1000):
+    """
+Given data points data, yield the subsample indexes of ``subsample_indexes``
+as arrays of at most ``chunk_size`` rows. Each row holds the positions of the
+``size`` smallest of a row of uniform draws, which is a uniformly random
+subsample; full-size subsamples are sorted, so that they are random
+permutations.
     """
     if size == -1:
         size = len(data)
     elif (size < 1) and (size > 0):
-        size = round(size*len(data))
+        size = int(round(size*len(data)))
     elif size > 1:
         pass
     else:
         raise ValueError("size cannot be {0}".format(size))
-    base = np.tile(np.arange(len(data)),(n_samples,1))
-    for sample in base: np.random.shuffle(sample)
-    return base[:,0:size]
+    for start in range(0, n_samples, chunk_size):
+        keys = np.random.random_sample((min(chunk_size,n_samples-start),len(data)))
+        if size < len(data):
+            yield np.argpartition(keys, size-1, axis=1)[:,0:size]
+        else:
+            yield np.argsort(keys, axis=1)
 
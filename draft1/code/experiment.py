@@ -68,7 +68,14 @@ class Experiment:
         return self.target_values2matrix(rnames, cnames, self.target_cis())
         
     def target_cis(self):        
-        return self.target_analysis(func=self.get_ci)
+        # All the cells are bootstrapped together; this matches calling
+        # self.get_ci on each of them in turn:
+        cells = [(form, cond, vals) for form, cond_dict in self.targets.items() for cond, vals in cond_dict.items()]
+        intervals = bootstrap.ci_mean_batch([vals for _, _, vals in cells], method='bca')
+        cis = defaultdict(lambda : defaultdict(list))
+        for (form, cond, _), interval in zip(cells, intervals):
+            cis[form][cond] = interval
+        return cis
 
     def get_ci(self, vals):
         if len(set(vals)) == 1:
@@ -217,6 +224,245 @@ class Experiment:
         else:
             plt.show()
 
+######################################################################
+# The same experiment held as one array per column of the spreadsheet:
+
+class ColumnarExperiment(Experiment):
+    """Experiment read straight into arrays instead of Item objects.
+    trialnum, response and rt are integer arrays; every other column is
+    categorical, stored as integer codes into the sorted labels in
+    self.categories. (A numeric column with missing values is float,
+    with nan for them.) Column names have '.' replaced by '_', as for Item.
+    The target responses are indexed by cell (formula by normalized
+    condition), so that counts and means are bincounts and the cells for
+    bootstrapping are slices of one sorted array. With an ExperimentCache
+    as cache, the columns are parsed once and then loaded from it."""
+
+    numeric_columns = ('trialnum', 'response', 'rt')
+    
+    def __init__(self, src_filename="../data/basketball-pilot-2-11-14-results-parsed.csv", cache=None):
+        self.src_filename = src_filename
+        self.cache = cache
+        if self.cache:
+            self.columns, self.categories = self.cache.read_columns(src_filename, self.read_columns, self.numeric_columns)
+        else:
+            self.columns, self.categories = self.read_columns(src_filename)
+        self.index_targets()
+        self.targets = defaultdict(lambda : defaultdict(list))
+        self.get_target_responses()
+
+    def read_columns(self, src_filename):
+        reader = csv.reader(file(src_filename))
+        header = [key.replace(".", "_") for key in reader.next()]
+        columns = {}
+        categories = {}
+        for key, vals in zip(header, zip(*reader)):
+            if key in self.numeric_columns:
+                columns[key] = self.integer_column(vals)
+            else:
+                labels, codes = np.unique(vals, return_inverse=True)
+                columns[key] = codes
+                categories[key] = list(labels)
+        return columns, categories
+
+    def integer_column(self, vals):
+        # Converting with int, since astype(int) on an array of strings can
+        # silently garble entries like 'null'. Columns with such missing
+        # values are float with nan for them:
+        try:
+            return np.array(map(int, vals))
+        except ValueError:
+            return np.array([float(val) if val.lstrip('-').isdigit() else np.nan for val in vals])
+
+    def index_targets(self):
+        # Formulae and normalized conditions of the categories, with -1 for non-target sentences:
+        sentence_formulae = [SENTENCES.get(sentence, None) for sentence in self.categories['sentence']]
+        condition_norms = [CONDITION_MAP.get(condition, None) for condition in self.categories['condition']]
+        self.formulae = sorted(set(sentence_formulae) - set([None]))
+        self.condition_norms = sorted(set(condition_norms))
+        sentence_codes = np.array([self.formulae.index(f) if f else -1 for f in sentence_formulae], dtype=int)
+        condition_codes = np.array([self.condition_norms.index(c) for c in condition_norms], dtype=int)
+        # Target rows and their cells:
+        formula = sentence_codes[self.columns['sentence']]
+        self.target_rows = np.flatnonzero(formula >= 0)
+        self.cells = formula[self.target_rows] * len(self.condition_norms) + condition_codes[self.columns['condition'][self.target_rows]]
+        self.cell_count = len(self.formulae) * len(self.condition_norms)
+
+    def cell_labels(self, cell):
+        return self.formulae[cell // len(self.condition_norms)], self.condition_norms[cell % len(self.condition_norms)]
+    
+    def cell_indices(self, rnames, cnames):
+        # The cells of the (rnames, cnames) matrices of target_values2matrix:
+        return np.array([[self.formulae.index(rname) * len(self.condition_norms) + self.condition_norms.index(cname) for cname in cnames] for rname in rnames])
+
+    def cells_in_file_order(self):
+        # The cells present, by first appearance; filling dictionaries in
+        # this order makes them iterate as those of Experiment do:
+        cells, first = np.unique(self.cells, return_index=True)
+        return cells[np.argsort(first)]
+
+    def get_target_responses(self):
+        cell_responses = self.group_responses(self.cells, self.cell_count)
+        for cell in self.cells_in_file_order():
+            form, cond = self.cell_labels(cell)
+            self.targets[form][cond] = cell_responses[cell]
+
+    def group_responses(self, cells, cell_count):
+        # The target responses split by the codes cells (one per target
+        # row); a stable sort keeps each group in file order:
+        order = np.argsort(cells, kind='mergesort')
+        responses = self.columns['response'][self.target_rows][order]
+        return np.split(responses, np.cumsum(np.bincount(cells, minlength=cell_count))[: -1])
+
+    def target_counts_by_cell(self):
+        return np.bincount(self.cells, minlength=self.cell_count)
+
+    def target_means_by_cell(self):
+        sums = np.bincount(self.cells, weights=self.columns['response'][self.target_rows], minlength=self.cell_count)
+        counts = self.target_counts_by_cell()
+        return sums / np.maximum(counts, 1), counts
+
+    def target_means(self):
+        means, counts = self.target_means_by_cell()
+        mu = defaultdict(lambda : defaultdict(list))
+        for cell in self.cells_in_file_order():
+            form, cond = self.cell_labels(cell)
+            mu[form][cond] = means[cell]
+        return mu
+
+    def subject_cell_stats(self):
+        # Sums and counts of the target responses of each subject (with any)
+        # in each cell, both of shape (subjects, cells):
+        subjects = np.unique(self.columns['workerid'][self.target_rows], return_inverse=True)[1]
+        codes = subjects * self.cell_count + self.cells
+        shape = (np.max(subjects)+1, self.cell_count)
+        counts = np.bincount(codes, minlength=np.prod(shape)).reshape(shape)
+        sums = np.bincount(codes, weights=self.columns['response'][self.target_rows], minlength=np.prod(shape)).reshape(shape)
+        return sums, counts
+
+    def target_cis_by_subject(self, n_samples=10000, seed=None):
+        """Like target_cis, but resampling subjects rather than responses,
+        since each subject's responses are correlated. All the cells'
+        intervals come from the same subject resamples."""
+        sums, counts = self.subject_cell_stats()
+        intervals = bootstrap.ci_cluster_means(sums, counts, method='bca', n_samples=n_samples, seed=seed)
+        cis = defaultdict(lambda : defaultdict(list))
+        for cell in self.cells_in_file_order():
+            form, cond = self.cell_labels(cell)
+            cis[form][cond] = intervals[cell]
+        return cis
+
+    def subject_count(self):
+        return len(np.unique(self.columns['workerid']))
+
+    def condition_presentation(self):
+        # Counts of (normalized condition, condition order) pairs among the targets:
+        d = defaultdict(lambda : defaultdict(int))
+        orders = self.columns['conditionOrder'][self.target_rows]
+        norms = self.cells % len(self.condition_norms)
+        pairs = np.bincount(norms * len(self.categories['conditionOrder']) + orders)
+        for pair in np.flatnonzero(pairs):
+            norm, order = divmod(pair, len(self.categories['conditionOrder']))
+            d[self.condition_norms[norm]][self.categories['conditionOrder'][order]] = pairs[pair]
+        return d
+
+    def response_counts(self, responses):
+        return np.bincount(responses, minlength=8)[1: 8]
+
+    def plot_response_distribution(self):
+        all_counts = self.response_counts(self.columns['response'])
+        target_counts = self.response_counts(self.columns['response'][self.target_rows])
+        fig, axarray = plt.subplots(nrows=1, ncols=2)
+        pos = np.arange(1.0, 8.0, 1.0)
+        barwidth = 1.0
+        for ax, counts, title in zip(axarray, (all_counts, target_counts), ('All items', 'Target items')):
+            ax.bar(pos, counts, barwidth)
+            ax.set_title(title)
+            ax.set_xlabel('Response category')
+            ax.set_ylabel('Count')
+        plt.show()
+
+######################################################################
+# Several runs of the experiment as one dataset:
+
+class PooledExperiment(ColumnarExperiment):
+    """The rows of several experiment files stacked into one columnar
+    dataset, with an 'experiment' column giving the index of each row's
+    file in src_filenames. Only the columns that all the files share are
+    kept, and categorical codes are over the union of the files' labels.
+    As an Experiment, it gives the pooled targets, so it can be handed to
+    Analysis as it is; the *_by_experiment methods add a leading axis with
+    one slice per file followed by the pooled slice, all computed in one
+    pass."""
+    def __init__(self, src_filenames, cache=None):
+        self.src_filenames = list(src_filenames)
+        self.src_filename = ", ".join(self.src_filenames)
+        self.cache = cache
+        self.experiments = [ColumnarExperiment(src_filename, cache=cache) for src_filename in self.src_filenames]
+        self.columns, self.categories = self.pool_columns(self.experiments)
+        self.index_targets()
+        self.targets = defaultdict(lambda : defaultdict(list))
+        self.get_target_responses()
+
+    def pool_columns(self, experiments):
+        keys = set.intersection(*[set(exp.columns) for exp in experiments])
+        columns = {}
+        categories = {}
+        for key in keys:
+            if all(key in exp.categories for exp in experiments):
+                labels = sorted(set().union(*[exp.categories[key] for exp in experiments]))
+                # Recode each experiment's codes as codes into the union:
+                recoded = [np.searchsorted(labels, exp.categories[key])[exp.columns[key]] for exp in experiments]
+                columns[key] = np.concatenate(recoded)
+                categories[key] = labels
+            else:
+                columns[key] = np.concatenate([exp.columns[key] for exp in experiments])
+        columns['experiment'] = np.repeat(np.arange(len(experiments)), [len(exp.columns['response']) for exp in experiments])
+        categories['experiment'] = self.src_filenames
+        return columns, categories
+
+    def experiment_cells(self):
+        # Cell codes over (experiment, formula, condition), with the pooled
+        # cells as a final experiment:
+        experiment = self.columns['experiment'][self.target_rows]
+        pooled = len(self.src_filenames) * self.cell_count
+        return np.concatenate((experiment * self.cell_count + self.cells, pooled + self.cells))
+
+    def target_shape(self):
+        return (len(self.src_filenames)+1, len(self.formulae), len(self.condition_norms))
+
+    def target_means_by_experiment(self):
+        """(means, counts), arrays indexed by (experiment, formula, condition)
+        as in self.formulae and self.condition_norms, with the pooled data as
+        the last experiment. Means of empty cells are nan."""
+        cells = self.experiment_cells()
+        responses = np.tile(self.columns['response'][self.target_rows], 2)
+        size = np.prod(self.target_shape())
+        counts = np.bincount(cells, minlength=size)
+        sums = np.bincount(cells, weights=responses, minlength=size)
+        means = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+        return means.reshape(self.target_shape()), counts.reshape(self.target_shape())
+
+    def target_cis_by_experiment(self, n_samples=10000):
+        """Bootstrap confidence intervals for the means of target_means_by_experiment,
+        as an array with a final (low, high) axis, nan for empty cells. All
+        the cells are bootstrapped in one batch."""
+        experiment = self.columns['experiment'][self.target_rows]
+        size = np.prod(self.target_shape())
+        groups = self.group_responses(experiment * self.cell_count + self.cells, len(self.src_filenames) * self.cell_count)
+        groups += self.group_responses(self.cells, self.cell_count)
+        present = [i for i, vals in enumerate(groups) if len(vals)]
+        cis = np.zeros((size, 2)) + np.nan
+        cis[present] = bootstrap.ci_mean_batch([groups[i] for i in present], method='bca', n_samples=n_samples)
+        return cis.reshape(self.target_shape() + (2,))
+
+    def by_experiment2matrix(self, rnames, cnames, values):
+        """The (experiment, rnames, cnames) slice of values, an array indexed
+        like those of target_means_by_experiment."""
+        rows = [self.formulae.index(rname) for rname in rnames]
+        cols = [self.condition_norms.index(cname) for cname in cnames]
+        return values[:, rows][:, :, cols]
+
 ######################################################################
     
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+######################################################################
+
+class ExperimentCache:
+    """Binary store of parsed experiment spreadsheets, for
+    ColumnarExperiment. Each file gets a directory named by a hash of its
+    contents and modification time, holding one .npy file per column, one
+    for the labels of each categorical column, and a JSON header listing
+    them. Columns are read back memory-mapped, so loading doesn't tokenize
+    any CSV and processes reading the same experiment share its pages."""
+    def __init__(self, cache_dir="../cache/experiments"):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def read_columns(self, src_filename, parse, numeric_columns=()):
+        """(columns, categories) for src_filename, as returned by parse
+        (ColumnarExperiment.read_columns), which is called only on the first
+        request for this version of the file."""
+        dirname = self.dirname(src_filename, numeric_columns)
+        if not os.path.exists(os.path.join(dirname, 'header.json')):
+            columns, categories = parse(src_filename)
+            self.store(dirname, src_filename, columns, categories)
+        return self.load(dirname)
+
+    def dirname(self, src_filename, numeric_columns=()):
+        return os.path.join(self.cache_dir, self.key(src_filename, numeric_columns))
+
+    def key(self, src_filename, numeric_columns=()):
+        digest = hashlib.sha1()
+        with open(src_filename, 'rb') as f:
+            for block in iter(lambda : f.read(2**20), ''):
+                digest.update(block)
+        digest.update(repr((os.path.getmtime(src_filename), sorted(numeric_columns))))
+        return digest.hexdigest()
+
+    def store(self, dirname, src_filename, columns, categories):
+        # Fill a temporary directory first so that other processes never see a partial entry:
+        tmpdir = tempfile.mkdtemp(dir=self.cache_dir, suffix='.tmp')
+        header = {'src_filename': src_filename, 'mtime': os.path.getmtime(src_filename), 'columns': {}}
+        for key, vals in columns.items():
+            np.save(os.path.join(tmpdir, '%s.npy' % key), vals)
+            header['columns'][key] = {'dtype': vals.dtype.str, 'categorical': key in categories}
+            if key in categories:
+                np.save(os.path.join(tmpdir, '%s.categories.npy' % key), np.array(categories[key]))
+        with open(os.path.join(tmpdir, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1, sort_keys=True)
+        try:
+            os.rename(tmpdir, dirname)
+        except OSError:
+            # Another process stored it first:
+            shutil.rmtree(tmpdir)
+
+    def load(self, dirname):
+        with open(os.path.join(dirname, 'header.json')) as f:
+            header = json.load(f)
+        columns = {}
+        categories = {}
+        for key, spec in header['columns'].items():
+            key = str(key)
+            columns[key] = np.load(os.path.join(dirname, '%s.npy' % key), mmap_mode='r')
+            if spec['categorical']:
+                categories[key] = list(np.load(os.path.join(dirname, '%s.categories.npy' % key)))
+        return columns, categories
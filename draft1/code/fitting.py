@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy.optimize import minimize
+from utils import transpose, safelog, logsumexp, batches
+
+######################################################################
+
+class ModelFit:
+    """Fits the temperature and message costs of a LexicalUncertaintyModel
+    to a matrix of human responses, like Analysis.expmat, whose rows are
+    the given messages and whose columns are the model's states.
+
+    The lexica are read once, collapsed with the model's deduplicate, and
+    kept as log literal listeners. Each evaluation of the loss and of its
+    exact gradient is then a few vectorized passes over them, and
+    L-BFGS-B needs only a handful of evaluations.
+
+    loss is 'mse' (mean squared error) or 'correlation' (negative Pearson
+    correlation). free_costs lists the indices of the messages whose costs
+    are fitted; by default just the null message's. Adding a constant to
+    all the costs leaves the speaker unchanged, so they can't all be free."""
+    def __init__(self, model, expmat, messages, loss='mse', free_costs=None, batch_size=1000, display_progress=True):
+        self.model = model
+        self.expmat = np.array(expmat)
+        self.rows = [model.messages.index(msg) for msg in messages]
+        self.loss = loss
+        if free_costs is None:
+            free_costs = [len(model.messages)-1] if model.nullmsg else []
+        self.free_costs = list(free_costs)
+        # Values for the costs that aren't fitted:
+        self.base_costs = np.array(model.costs, dtype=float)
+        self.result = None
+        # Log literal listeners as (batch, states, messages) stacks, with the
+        # -inf entries zeroed and flagged so that they drop out of gradients:
+        self.batches = []
+        lexica, _ = model.deduplicate(model.weighted_lexica(display_progress=display_progress))
+        for batch in batches(lexica, batch_size):
+            weights, stack = zip(*batch)
+            loglis = transpose(safelog(model.l0(np.array(stack))))
+            finite = np.isfinite(loglis)
+            self.batches.append((np.array(weights), np.where(finite, loglis, 0.0), finite))
+
+    def fit(self, temperature=None, costs=None, min_temperature=0.01, **kwargs):
+        """Minimizes the loss from the model's current settings (or the given
+        ones), installs the best settings and their lexical uncertainty
+        listener in the model (see store_marginal), and returns the
+        scipy.optimize result. kwargs go to minimize."""
+        temperature = self.model.temperature if temperature is None else temperature
+        costs = self.model.costs if costs is None else costs
+        self.base_costs = np.array(costs, dtype=float)
+        x0 = np.concatenate(([temperature], self.base_costs[self.free_costs]))
+        bounds = [(min_temperature, None)] + [(None, None)] * len(self.free_costs)
+        self.result = minimize(self.loss_and_gradient, x0, jac=True, method='L-BFGS-B', bounds=bounds, **kwargs)
+        self.model.temperature, self.model.costs = self.settings(self.result.x)
+        self.model.final_listener = self.listener(self.model.temperature, self.model.costs)
+        # The old marginal, depth and traces belong to the old settings:
+        self.model.store_marginal()
+        return self.result
+
+    def settings(self, params):
+        """(temperature, costs) for the parameter vector params."""
+        costs = self.base_costs.copy()
+        costs[self.free_costs] = params[1: ]
+        return params[0], costs
+
+    def speakers(self, temperature, costs):
+        """Yields (weights, speakers, log speakers) for the batches of lexica."""
+        for weights, loglis, finite in self.batches:
+            utility = np.where(finite, temperature * (loglis - costs), -np.inf)
+            # Shifting by the best message's utility keeps exp from overflowing:
+            utility -= np.max(utility, axis=2)[..., np.newaxis]
+            spk = np.exp(utility)
+            total = np.sum(spk, axis=2)[..., np.newaxis]
+            yield weights, spk / total, utility - np.log(total)
+
+    def marginal(self, spks):
+        """The weighted sum of the transposed speakers, and the same sum in
+        the log domain, as LexicalUncertaintyModel.speaker_sum gives them."""
+        total = np.zeros((len(self.model.messages), len(self.model.states)))
+        logtotal = np.zeros(total.shape) - np.inf
+        for weights, spk, logspk in spks:
+            total += np.tensordot(weights, spk, axes=1).T
+            np.logaddexp(logtotal, logsumexp(logspk + np.log(weights)[:, np.newaxis, np.newaxis], axis=0).T, out=logtotal)
+        return total, logtotal
+
+    def listener(self, temperature, costs):
+        """The lexical uncertainty listener for the given settings."""
+        return self.model.normalize_marginal(*self.marginal(self.speakers(temperature, costs)))
+
+    def loss_and_gradient(self, params):
+        """The loss at params and its gradient with respect to params,
+        backpropagated through the row normalization of the listener, the
+        sum over lexica and the speaker's softmax."""
+        temperature, costs = self.settings(params)
+        prior = self.model.stateprior
+        spks = list(self.speakers(temperature, costs))
+        total, logtotal = self.marginal(spks)
+        lis = self.model.normalize_marginal(total, logtotal)
+        loss, grad_lis = self.loss_function(lis[self.rows])
+        # Back through the listener's row normalization, up to the division
+        # by each row's total (rows outside self.rows don't touch the loss):
+        G = np.zeros(lis.shape)
+        G[self.rows] = prior * (grad_lis - np.sum(grad_lis * lis[self.rows], axis=1)[:, np.newaxis])
+        logrowtotals = logsumexp(logtotal + safelog(prior), axis=1)
+        # Back through the speakers' softmax over messages, lexicon by lexicon.
+        # The speakers are divided by the row totals in the log domain, since
+        # at high temperatures both can underflow:
+        grad_temperature = 0.0
+        grad_costs = np.zeros(len(costs))
+        for (weights, spk, logspk), (_, loglis, _) in zip(spks, self.batches):
+            P = np.exp(logspk - logrowtotals) * G.T
+            R = weights[:, np.newaxis, np.newaxis] * (P - spk * np.sum(P, axis=2)[..., np.newaxis])
+            grad_temperature += np.sum(R * (loglis - costs))
+            grad_costs -= temperature * np.sum(R, axis=(0, 1))
+        return loss, np.concatenate(([grad_temperature], grad_costs[self.free_costs]))
+
+    def loss_function(self, lis):
+        """The loss comparing lis to self.expmat, and its gradient with respect to lis."""
+        if self.loss == 'mse':
+            diff = lis - self.expmat
+            return np.mean(diff**2), 2.0 * diff / diff.size
+        elif self.loss == 'correlation':
+            x = lis - np.mean(lis)
+            y = self.expmat - np.mean(self.expmat)
+            sx = np.sqrt(np.sum(x**2))
+            sy = np.sqrt(np.sum(y**2))
+            r = np.sum(x * y) / (sx * sy)
+            return -r, -(y / (sx * sy) - r * x / sx**2)
+        raise ValueError("Loss %s is not supported" % self.loss)
+
+    def report(self, digits=4):
+        print "=" * 70 # Divider bar.
+        print 'Fit of', self.model.name, 'by', self.loss
+        print 'Converged:', self.result.success, '(%s evaluations)' % self.result.nfev
+        print 'Loss:', np.round(self.result.fun, digits)
+        print 'Temperature:', np.round(self.model.temperature, digits)
+        for i in self.free_costs:
+            print 'Cost of %s:' % self.model.messages[i], np.round(self.model.costs[i], digits)
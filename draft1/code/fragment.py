@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 import sys
+import itertools
 from itertools import product
+from collections import defaultdict
+import numpy as np
 from utils import powerset
 
 ######################################################################
@@ -69,8 +72,47 @@ def tv(V, Q, worlds, subjects):
     and combining it with the set of sets Q to return an intensional
     property. The dependence on worlds and subjects is unfortunate but
     I don't see how to avoid it."""    
-    return [[w,x] for w, x in product(worlds, subjects) if [y for w_prime, x_prime, y in V if w_prime == w and x_prime == x] in Q]
+    truth = tv_matrix(V, Q, worlds, subjects)
+    return [[w,x] for (i, w), (j, x) in product(enumerate(worlds), enumerate(subjects)) if truth[i, j]]
 
+def tv_matrix(V, Q, worlds, subjects):
+    """The property tv(V, Q, worlds, subjects) as a boolean world by subject
+    array. V is looked up through relation_index, and Q is turned into a set
+    once, so each cell costs a pair of hash lookups."""
+    index = relation_index(V)
+    members = set(tuple(Y) for Y in Q)
+    return np.array([[tuple(index.get((w, x), ())) in members for x in subjects] for w in worlds], dtype=bool).reshape(len(worlds), len(subjects))
+
+# The most recent relation index, as a (relation, index) pair; relations
+# like hit are usually fixed across lexica, so this is rarely rebuilt:
+_relation_index = (None, None)
+
+def relation_index(V):
+    """Maps each (world, subject) pair in the relation V to the list of its
+    objects, in the order they appear in V."""
+    global _relation_index
+    relation, index = _relation_index
+    if relation is not V:
+        index = defaultdict(list)
+        for w, x, y in V:
+            index[(w, x)].append(y)
+        index = dict(index)
+        _relation_index = (V, index)
+    return index
+
+def refinements(semval):
+    """All the non-empty subsets of the denotation semval."""
+    return powerset(semval, minsize=1)
+
+def random_refinement(semval, random_state):
+    """A uniform draw from refinements(semval) without listing them: each
+    member is kept with probability 1/2, and empty draws are redrawn."""
+    if not semval:
+        raise ValueError("An empty denotation has no non-empty refinements")
+    while True:
+        keep = random_state.rand(len(semval)) < 0.5
+        if keep.any():
+            return [x for x, kept in zip(semval, keep) if kept]
     
 ######################################################################
 
@@ -86,6 +128,75 @@ def get_worlds(basic_states=(0,1,2), length=3, increasing=False):
 def worldname(w):
     return "".join(["NSA"[i] for i in w])
 
+######################################################################
+# Symmetries. A world lists the players' shot counts in the order of
+# player, so permuting the players permutes the positions of the worlds;
+# shots are told apart only by their names.
+
+def permutations(player=[], shot=[], worlds=[]):
+    """Yields a mapping for every pair of permutations of player and shot
+    under which worlds is closed. Each maps the entities to their images,
+    and each world w to the world in which the image of every player x
+    has x's shot count at w."""
+    worldset = set(worlds)
+    for players in itertools.permutations(player):
+        for shots in itertools.permutations(shot):
+            mapping = dict(zip(player, players) + zip(shot, shots))
+            for w in worlds:
+                image = [None] * len(player)
+                for x, count in zip(player, w):
+                    image[player.index(mapping[x])] = count
+                mapping[w] = tuple(image)
+            if all(mapping[w] in worldset for w in worlds):
+                yield mapping
+
+def permute(semval, mapping):
+    """The denotation semval, as listed or in canonical form, with every
+    entity and world replaced by its image under mapping."""
+    if isinstance(semval, list):
+        return [permute(x, mapping) for x in semval]
+    if semval in mapping:
+        return mapping[semval]
+    if isinstance(semval, (tuple, frozenset)):
+        return type(semval)(permute(x, mapping) for x in semval)
+    return semval
+
+def invariant(semval, mapping):
+    """Whether mapping fixes semval; pass the canonical form when testing
+    many mappings."""
+    semval = canonical(semval)
+    return permute(semval, mapping) == semval
+
+def canonical(semval):
+    """semval as a hashable value that doesn't depend on the order in which
+    its members are listed. Denotations are sets, and so are the lists of
+    entities among their members; the other members ([w, x], [w, x, y] and
+    [X, Y]) are tuples."""
+    if isinstance(semval, list):
+        return frozenset(canonical_member(x) for x in semval)
+    return semval
+
+def canonical_member(x):
+    if isinstance(x, list):
+        if all(isinstance(y, str) for y in x):
+            return frozenset(x)
+        return tuple(canonical_member(y) for y in x)
+    return x
+
+def orbits(worlds, mappings):
+    """Partition of the indices of worlds into the orbits of the
+    permutations in mappings (which should form a group), each listed in
+    the order of worlds and the orbits ordered by their first members."""
+    index = dict((w, i) for i, w in enumerate(worlds))
+    seen = set()
+    parts = []
+    for i, w in enumerate(worlds):
+        if i not in seen:
+            orbit = sorted(set(index[mapping[w]] for mapping in mappings) | set([i]))
+            seen.update(orbit)
+            parts.append(orbit)
+    return parts
+
 ######################################################################
 
 if __name__ == '__main__':
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 
-import sys
-import itertools
+import ast
 import numpy as np
+import fragment
 from fragment import *
-from utils import display_matrix, powerset, NULL
+from utils import display_matrix, NULL
+from sparse_lexicon import SparseLexica
 
 ######################################################################
 
@@ -14,60 +15,296 @@ class UncertaintyGrammars:
                  messages=[],
                  worlds=[],
                  refinable={},
-                 nullmsg=True):
+                 nullmsg=True,
+                 semantics=fragment,
+                 cache=None):
         self.worlds = worlds
         self.refinable = refinable
         self.nullmsg = nullmsg
+        # Module supplying fa, iv, tv and refinements for the baselexicon's
+        # representation (fragment or bitfragment):
+        self.semantics = semantics
+        # Optional lexicon_cache.LexiconCache holding the enumerated lexica:
+        self.cache = cache
         if self.nullmsg:
             messages.append(("NULL", None))
         self.messages, self.formulae = zip(*messages)
         self.messages = list(self.messages)
         self.formulae = list(self.formulae)
         self.baselexicon = baselexicon
+        # Formulae are parsed just once; names other than words resolve to
+        # the semantics module (fa, iv, tv, ...) or to this grammar (self):
+        self.namespace = dict(vars(self.semantics), self=self)
+        self.compile()
+
+    def compile(self):
+        """Parses the formulae for evaluation at self.worlds."""
+        self.compiled_formulae = [Formula(phi, self.baselexicon, self.namespace, self.worlds) if phi else None
+                                  for phi in self.formulae]
         self.baselexicon_mat = self.interpretation_matrix(self.baselexicon)
         
-    def lexicon_iterator(self):
+    def lexicon_iterator(self, start=None, stop=None):
+        """Interpretation matrices for all the refined lexica. Without a
+        cache, they are enumerated by enumerate_lexica and start and stop
+        index the product of the refinements. With one, they are read from
+        the cached tensor and start and stop index the lexica themselves;
+        either way, lexicon_space_size gives the matching size."""
+        if self.cache:
+            return iter(self.cache.lexica(self)[start: stop])
+        return self.enumerate_lexica(start=start, stop=stop)
+
+    def enumerate_lexica(self, start=None, stop=None):
+        """Interpretation matrices for all the refined lexica, in the order
+        of the product of the refinements. start and stop pick out a range
+        of indices into that product (before filtering), which lets the space
+        be divided among processes.
+
+        Lexica containing messages that denote {} need to be filtered on the
+        current formulation of the model. Rather than building every matrix
+        and then checking, we assign refinements one word at a time and
+        interpret each message as soon as all of its words have meanings.
+        If it comes out empty, every lexicon extending the partial assignment
+        would be filtered, so the whole subtree is skipped."""
         words, refinements = zip(*self.get_all_refinements().items())
-        for meaning_vector in itertools.product(*refinements):
-            lex = dict(zip(words, meaning_vector))
-            mat = self.interpretation_matrix(lex)
-            # Lexica containing messages that denote {} need to be filtered on
-            # the current formulation of the model:
-            if 0.0 not in np.sum(mat, axis=1):
+        positions = dict((word, i) for i, word in enumerate(words))
+        # ready[depth] lists the messages fully interpretable once the first depth words are assigned:
+        ready = [[] for _ in range(len(words)+1)]
+        for i, formula in enumerate(self.compiled_formulae):
+            if formula:
+                ready[max([positions[word]+1 for word in formula.free_words] + [0])].append(i)
+        # Number of lexica below a node at each depth, for locating index ranges:
+        sizes = [int(np.prod([len(r) for r in refinements[depth: ]])) for depth in range(len(words)+1)]
+        start = 0 if start is None else start
+        stop = sizes[0] if stop is None else min(stop, sizes[0])
+        mat = np.zeros((len(self.messages), len(self.worlds)))
+        if self.nullmsg:
+            mat[-1] = np.ones(len(self.worlds))
+        env = dict(self.baselexicon)
+        def search(depth, offset):
+            for i in ready[depth]:
+                mat[i] = self.compiled_formulae[i].truth_values(env)
+                if not mat[i].any():
+                    return
+            if depth == len(words):
+                yield mat.copy()
+                return
+            for k, semval in enumerate(refinements[depth]):
+                lower = offset + k * sizes[depth+1]
+                if lower < stop and lower + sizes[depth+1] > start:
+                    env[words[depth]] = semval
+                    for lex in search(depth+1, lower):
+                        yield lex
+        return search(0, 0)
+
+    def sample_lexica(self, seed=None):
+        """Endless iterator of interpretation matrices drawn independently and
+        uniformly from the lexica of enumerate_lexica, for spaces too large
+        to enumerate. Each refinable word gets a uniformly random refinement;
+        one refined to all the subsets of its denotation gets one from the
+        semantics' random_refinement, so the subsets are never listed.
+        Draws in which a message denotes {} are redrawn, which keeps the
+        draws uniform over the lexica that enumerate_lexica would yield."""
+        random_state = np.random.RandomState(seed)
+        words = sorted(word for word in self.refinable if word in self.baselexicon)
+        options = dict((word, self.word_refinements(word)) for word in words if self.refinable[word])
+        while True:
+            lexicon = {}
+            for word in words:
+                if word in options:
+                    lexicon[word] = options[word][random_state.randint(len(options[word]))]
+                else:
+                    lexicon[word] = self.semantics.random_refinement(self.baselexicon[word], random_state)
+            mat = self.interpretation_matrix(lexicon)
+            if mat.any(axis=1).all():
                 yield mat
 
+    def sparse_lexica(self, chunk_size=1000):
+        """The lexica of lexicon_iterator as a sparse_lexicon.SparseLexica."""
+        return SparseLexica.from_dense(self.lexicon_iterator(), len(self.messages), len(self.worlds), chunk_size=chunk_size)
+
+    def lexicon_space_size(self):
+        """Number of candidate lexica, i.e., the size of the product of the
+        refinements, or the number of cached lexica when there is a cache."""
+        if self.cache:
+            return len(self.cache.lexica(self, display_progress=False))
+        return int(np.prod([len(refinements) for refinements in self.get_all_refinements().values()]))
+
     def interpretation_matrix(self, lexicon):
-        for word, sem in lexicon.items():
-            setattr(sys.modules[__name__], word, sem)
+        # Words not mentioned in lexicon keep their base meanings:
+        env = dict(self.baselexicon)
+        env.update(lexicon)
         m = len(self.messages)
         n = len(self.worlds)           
         mat = np.zeros((m, n))
-        for i, phi in enumerate(self.formulae):
-            for j, w in enumerate(self.worlds):                
-                if phi and eval(phi)(w):
-                    mat[i,j] = 1.0
+        for i, formula in enumerate(self.compiled_formulae):
+            if formula:
+                mat[i] = formula.truth_values(env)
         if self.nullmsg:
             mat[-1] = np.ones(n)
         return mat
  
     def get_all_refinements(self):
-        # Make sure we're in the baselexicon namespace:
-        for word, sem in self.baselexicon.items():
-            setattr(sys.modules[__name__], word, sem)
-        # Refiments:
-        refine = {}
-        for word, semval in self.baselexicon.items():
-            if word in self.refinable:
-                if self.refinable[word]:
-                    refine[word] = [semval] + [eval(phi) for phi in self.refinable[word]]
-                else:
-                    refine[word] = self.refinements(semval)
-            else:
-                refine[word] = [semval]
-        return refine
+        return dict((word, self.word_refinements(word)) for word in self.baselexicon)
+
+    def word_refinements(self, word):
+        # Refiments, with any formulae interpreted in the baselexicon:
+        semval = self.baselexicon[word]
+        if word in self.refinable:
+            if self.refinable[word]:
+                return [semval] + [Formula(phi, self.baselexicon, self.namespace).evaluate(self.baselexicon) for phi in self.refinable[word]]
+            return self.refinements(semval)
+        return [semval]
 
     def refinements(self, semval):
-        return powerset(semval, minsize=1)
+        return self.semantics.refinements(semval)
+       
+######################################################################
+
+class SymmetricUncertaintyGrammars(UncertaintyGrammars):
+    """UncertaintyGrammars over the orbits of worlds under the permutations
+    of player and shot that leave every lexicon invariant (see
+    fragment.permutations). Such a permutation maps each world's column of
+    every interpretation matrix to an identical column, so the speakers
+    agree across each orbit, and with the state prior multiplied by the
+    orbit sizes (stateprior) a model run on the first world of each orbit
+    (self.worlds) gives each listener summed over the orbits. expand and
+    expand_speaker recover the matrices over all_worlds.
+
+    A permutation is kept only if it fixes the denotation of every word in
+    the messages under each of the word's refinements; for a word refined
+    to all the subsets of its denotation, it must fix each member. The
+    check is on the fragment representation, so baselexicon must come
+    from fragment.define_lexicon over all of worlds."""
+    def __init__(self,
+                 baselexicon=None,
+                 messages=[],
+                 worlds=[],
+                 refinable={},
+                 nullmsg=True,
+                 player=[],
+                 shot=[],
+                 cache=None):
+        UncertaintyGrammars.__init__(self, baselexicon=baselexicon, messages=messages, worlds=worlds,
+                                     refinable=refinable, nullmsg=nullmsg, semantics=fragment, cache=cache)
+        self.all_worlds = list(worlds)
+        self.symmetries = self.find_symmetries(player, shot)
+        self.orbits = orbits(self.all_worlds, self.symmetries)
+        self.multiplicities = np.array([len(orbit) for orbit in self.orbits])
+        # Column of each world's orbit in the reduced matrices:
+        self.orbit_index = np.zeros(len(self.all_worlds), dtype=int)
+        for j, orbit in enumerate(self.orbits):
+            self.orbit_index[orbit] = j
+        self.worlds = [self.all_worlds[orbit[0]] for orbit in self.orbits]
+        self.compile()
+
+    def find_symmetries(self, player, shot):
+        words = set().union(*[formula.free_words for formula in self.compiled_formulae if formula])
+        denotations = []
+        for word in sorted(words):
+            if word in self.refinable and not self.refinable[word]:
+                denotations += [[x] for x in self.baselexicon[word]]
+            else:
+                denotations += self.word_refinements(word)
+        denotations = [canonical(semval) for semval in denotations]
+        return [mapping for mapping in permutations(player, shot, self.all_worlds)
+                if all(invariant(semval, mapping) for semval in denotations)]
+
+    def stateprior(self, prior=None):
+        """The prior over self.worlds: the total of prior (by default flat
+        over all_worlds, and otherwise constant on each orbit) over each
+        orbit."""
+        if prior is None:
+            prior = np.repeat(1.0/len(self.all_worlds), len(self.all_worlds))
+        return np.bincount(self.orbit_index, weights=prior)
+
+    def expand(self, lis, prior=None):
+        """The listener (messages, self.worlds) lis over all_worlds, sharing
+        each orbit's probability among its worlds in proportion to prior."""
+        if prior is None:
+            prior = np.repeat(1.0/len(self.all_worlds), len(self.all_worlds))
+        return lis[:, self.orbit_index] * (prior / self.stateprior(prior)[self.orbit_index])
+
+    def expand_speaker(self, spk):
+        """The speaker (self.worlds, messages) spk over all_worlds."""
+        return spk[self.orbit_index]
+
+######################################################################
+
+class Formula:
+    """A formula string like "iv(some_player, scored)" parsed once into a
+    tree of closures. Names of words in the lexicon are looked up in the
+    lexicon passed to evaluate; all other names are resolved in namespace
+    when the formula is compiled. Every subformula remembers its value for
+    the last denotations of the words it contains, so the parts of a
+    formula that don't involve refined words are computed only once across
+    all the lexica."""
+    def __init__(self, phi, words, namespace, worlds=None):
+        self.phi = phi
+        self.words = set(words)
+        self.namespace = namespace
+        self.worlds = worlds
+        self.evaluate, self.free_words = self.compile(ast.parse(phi.strip(), mode='eval').body)
+        self.truth_values = memoize(self.get_truth_values, self.free_words)
+
+    def get_truth_values(self, lexicon):
+        """Vector of 1.0/0.0 values for the proposition at each of self.worlds."""
+        prop = self.evaluate(lexicon)
+        # Propositions can come already as boolean vectors over the worlds:
+        if isinstance(prop, np.ndarray):
+            return prop.astype(float)
+        return np.array([1.0 if prop(w) else 0.0 for w in self.worlds])
+
+    def compile(self, node):
+        """Returns a pair (function from lexica to values, set of words the value depends on)."""
+        if isinstance(node, ast.Name):
+            if node.id in self.words:
+                word = node.id
+                return (lambda lexicon : lexicon[word]), set([word])
+            if node.id not in self.namespace:
+                raise NameError("name '%s' in formula %s is neither a word nor defined" % (node.id, self.phi))
+            return self.constant(self.namespace[node.id])
+        elif isinstance(node, ast.Attribute):
+            func, free_words = self.compile(node.value)
+            if free_words:
+                raise ValueError("attributes of words are not supported: %s" % self.phi)
+            return self.constant(getattr(func(None), node.attr))
+        elif isinstance(node, ast.Num):
+            return self.constant(node.n)
+        elif isinstance(node, ast.Str):
+            return self.constant(node.s)
+        elif isinstance(node, (ast.Tuple, ast.List)):
+            compiled = [self.compile(elt) for elt in node.elts]
+            funcs = [func for func, _ in compiled]
+            free_words = set().union(*[words for _, words in compiled])
+            container = tuple if isinstance(node, ast.Tuple) else list
+            return memoize(lambda lexicon : container(func(lexicon) for func in funcs), free_words), free_words
+        elif isinstance(node, ast.Call) and not (node.keywords or node.starargs or node.kwargs):
+            operator, operator_words = self.compile(node.func)
+            compiled = [self.compile(arg) for arg in node.args]
+            funcs = [func for func, _ in compiled]
+            free_words = operator_words.union(*[words for _, words in compiled])
+            return memoize(lambda lexicon : operator(lexicon)(*[func(lexicon) for func in funcs]), free_words), free_words
+        raise ValueError("unsupported syntax in formula %s" % self.phi)
+
+    def constant(self, val):
+        return (lambda lexicon : val), set()
+
+def memoize(func, free_words):
+    """Wraps the function func of lexica so that it is recomputed only when
+    one of the denotations of free_words differs (by identity) from the
+    previous call. The cache is swapped in as a single tuple, so concurrent
+    callers at worst recompute a value."""
+    words = sorted(free_words)
+    cache = [None]
+    def memoized(lexicon):
+        denotations = tuple(lexicon[word] for word in words)
+        cached = cache[0]
+        if cached is not None and all(x is y for x, y in zip(cached[0], denotations)):
+            return cached[1]
+        val = func(lexicon)
+        cache[0] = (denotations, val)
+        return val
+    return memoized
        
 ######################################################################
 
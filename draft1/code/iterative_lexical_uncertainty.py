@@ -1,7 +1,21 @@
 import sys
+import itertools
+import multiprocessing
 from copy import copy
 import numpy as np
-from utils import rownorm, colnorm, safelog, display_matrix
+from utils import rownorm, colnorm, transpose, safelog, expnorm, lognorm, logsumexp, display_matrix, batches
+
+######################################################################
+
+# The model whose lexicon space is being shared out to a process pool. It
+# is set in the parent just before the pool forks, so that the workers
+# inherit it rather than having to unpickle it (lexicon_iterator is
+# usually a bound method, which pickle can't handle):
+_pool_model = None
+
+def _pool_partial_marginal(block):
+    start, stop, batch_size, dedup = block
+    return _pool_model.partial_marginal(start, stop, batch_size=batch_size, dedup=dedup)
 
 ######################################################################
         
@@ -13,6 +27,7 @@ class LexicalUncertaintyModel:
                  messages=None,
                  states=None,
                  lexcount=None,
+                 lexicon_space_size=None,
                  stateprior=None,
                  lexprior=None,
                  costs=None,
@@ -27,19 +42,26 @@ class LexicalUncertaintyModel:
         self.stateprior = stateprior
         self.lexprior = lexprior
         self.lexcount = lexcount
+        # Number of distinct interpretation matrices, filled in by run(dedup=True)
+        # without processes; the blocks of a pool are deduplicated separately,
+        # so the count over the whole space isn't known there and this is None:
+        self.distinct_lexcount = None
+        # Number of candidate lexica that lexicon_iterator(start, stop) indexes
+        # into; only needed for running on a process pool:
+        self.lexicon_space_size = lexicon_space_size
         self.costs = costs
         self.temperature = temperature
         self.nullmsg = nullmsg
         self.nullcost = nullcost
         # If no state prior is given, define a flat prior over states:
-        if self.stateprior == None:
+        if self.stateprior is None:
             self.stateprior = np.repeat(1.0/len(self.states), len(self.states))
         # If no lexicon prior is given, but we do know the number of lexica,
         # define a flat prior over lexica. If no count is given, we lead this
         # undefined and the lexicon prior is implicitly flat.             
-        if self.lexprior == None and self.lexcount != None:
+        if self.lexprior is None and self.lexcount is not None:
             self.lexprior = np.repeat(1.0/self.lexcount, self.lexcount)        
-        if self.costs == None:
+        if self.costs is None:
             self.costs = np.zeros(len(self.messages))
             if self.nullmsg:
                 self.costs[-1] = self.nullcost
@@ -47,6 +69,18 @@ class LexicalUncertaintyModel:
         self.final_listener = np.zeros((len(self.messages), len(self.states)))
         # This will get fill in if we reason beyond the lexical uncertainty listener:
         self.final_speaker = None
+        # The lexical uncertainty listener as run leaves it, so that iterate
+        # can restart from it, and the depth of final_listener beyond it:
+        self.marginal_listener = None
+        self.marginal_settings = None
+        self.depth = 0
+        # Filled in by iterate with a tolerance and with trace=True:
+        self.converged = None
+        self.listener_trace = None
+        self.speaker_trace = None
+        # Filled in by run_sampled:
+        self.standard_error = None
+        self.error_trace = None
 
     def rsa(self):
         lit = self.l0(self.baselexicon)
@@ -54,37 +88,457 @@ class LexicalUncertaintyModel:
         lis = self.L(spk)
         return [lit, spk, lis]
 
-    def run(self, n=0, display_progress=True):
+    def run(self, n=0, display_progress=True, batch_size=None, processes=None, block_size=1000, dedup=False, tolerance=None, trace=False, sparse_lexica=None):
+        """Marginalize over the lexica and then optionally iterate S and L
+        n more times, stopping early once the listener changes by no more
+        than tolerance, if given (see iterate). If batch_size is given, the lexica are stacked into
+        (batch_size, messages, states) tensors and each stack is pushed
+        through l0 and S in one go, which avoids the per-lexicon overhead
+        of the small NumPy calls; batch_size bounds the memory used.
+        If processes is given, the lexicon space is split into blocks of
+        block_size candidate lexica that are marginalized on a pool of
+        that many processes (see run_parallel). If dedup is True, lexica
+        with identical interpretation matrices are collapsed so that the
+        speaker is computed once per distinct lexicon (see deduplicate);
+        the number of distinct lexica is kept in distinct_lexcount, except
+        with processes, which deduplicate only within blocks and leave it
+        None. If sparse_lexica (a sparse_lexicon.SparseLexica) is given, the
+        lexica come from it instead of lexicon_iterator and are taken
+        block_size at a time by sparse_speaker_sum; that path has its own
+        kernels, so processes, batch_size and dedup don't apply to it and
+        raise ValueError. block_size is used only with processes or
+        sparse_lexica."""
+        if sparse_lexica is not None:
+            ignored = [name for name, value in (('processes', processes), ('batch_size', batch_size), ('dedup', dedup)) if value]
+            if ignored:
+                raise ValueError("%s can't be combined with sparse_lexica" % ", ".join(ignored))
+        self.distinct_lexcount = None
+        if sparse_lexica is not None:
+            marginal, logmarginal, lexcount = self.sparse_speaker_sum(sparse_lexica, block_size=block_size, display_progress=display_progress)
+            self.final_listener += marginal
+        elif processes:
+            logmarginal, lexcount = self.run_parallel(processes, block_size, batch_size=batch_size, dedup=dedup, display_progress=display_progress)
+        else:
+            lexica = self.weighted_lexica(display_progress=display_progress)
+            if dedup:
+                lexica, lexcount = self.deduplicate(lexica)
+                marginal, logmarginal, self.distinct_lexcount = self.speaker_sum(lexica, batch_size=batch_size)
+            else:
+                marginal, logmarginal, lexcount = self.speaker_sum(lexica, batch_size=batch_size)
+            self.final_listener += marginal
+        # Update or fill in the lexcount based on the iteration:
+        self.lexcount = lexcount
+        # Final normalization and state prior incorporation:
+        self.final_listener = self.normalize_marginal(self.final_listener, logmarginal)
+        self.store_marginal()
+        # Optional further iteration of L and S with no lexical uncertainty:
+        self.iterate(n, tolerance=tolerance, trace=trace)
+
+    def run_sampled(self, lexica, n=0, target_error=0.01, batch_size=100, min_samples=1000, max_samples=10**6, display_progress=True, tolerance=None, trace=False):
+        """Like run, but estimating the marginal over the lexica from draws
+        out of the iterator lexica, for spaces too large to enumerate; the
+        draws should be uniform over the lexicon space, like those of
+        UncertaintyGrammars.sample_lexica. If self.lexprior is given, it must
+        be a function from interpretation matrices to (unnormalized) prior
+        probabilities, and the draws are importance-weighted by it.
+
+        Draws are taken batch_size at a time until, after at least
+        min_samples of them, no entry of the listener has an estimated
+        standard error above target_error, or until max_samples. The error
+        is the delta-method estimate for the ratio of weighted sums that
+        the listener is (see listener_error); if it comes out nan, this
+        raises ValueError rather than drawing on. It is reported after each
+        batch, left in self.standard_error, and the (draws, largest error)
+        pairs are kept in self.error_trace. Returns whether the target was
+        reached."""
+        if self.lexprior is not None and not callable(self.lexprior):
+            raise ValueError("Sampled lexica have no index into a lexicon prior array; give the prior as a function of interpretation matrices")
+        m, n_states = len(self.messages), len(self.states)
+        # Running sums over the draws of U = prior * weight * S.T, of its
+        # row sums Y, and of the products that the error needs. At high
+        # temperatures, U underflows for costly messages like NULL, so each
+        # message's sums are kept relative to exp(scale), scale being the
+        # largest log U drawn for it so far; the listener and its errors
+        # don't depend on that factor:
+        sums = dict((key, np.zeros((m, n_states))) for key in ('U', 'UU', 'UY'))
+        sums['Y'] = np.zeros((m, 1))
+        sums['YY'] = np.zeros((m, 1))
+        scale = np.zeros((m, 1)) - np.inf
+        count = 0
+        work = self.workspace(batch_size)
+        self.error_trace = []
+        for batch in batches(itertools.islice(lexica, max_samples), batch_size):
+            stack = np.array(batch)
+            if self.lexprior is not None:
+                weights = np.array([self.lexprior(lex) for lex in stack], dtype=float)
+            else:
+                weights = np.ones(len(stack))
+            self.speaker_into(stack, work)
+            logU = safelog(weights)[:, np.newaxis, np.newaxis] + safelog(self.stateprior) + transpose(work['logspk'][: len(stack)])
+            # Rescale the sums to any new maxima (messages with none yet stay unscaled):
+            newscale = np.maximum(scale, np.max(np.max(logU, axis=2), axis=0)[:, np.newaxis])
+            scaled = np.isfinite(newscale)
+            with np.errstate(invalid='ignore'):
+                factor = np.where(scaled, np.exp(scale - newscale), 1.0)
+            for key in ('U', 'Y'):
+                sums[key] *= factor
+            for key in ('UU', 'UY', 'YY'):
+                sums[key] *= factor**2
+            scale = newscale
+            U = np.exp(logU - np.where(scaled, scale, 0.0))
+            Y = np.sum(U, axis=2, keepdims=True)
+            sums['U'] += np.sum(U, axis=0)
+            sums['UU'] += np.sum(U**2, axis=0)
+            sums['UY'] += np.sum(U * Y, axis=0)
+            sums['Y'] += np.sum(Y, axis=0)
+            sums['YY'] += np.sum(Y**2, axis=0)
+            count += len(stack)
+            self.standard_error = self.listener_error(sums, count)
+            error = np.max(self.standard_error)
+            if np.isnan(error):
+                raise ValueError("The standard error is nan after %s draws; some message has weight 0 in all of them" % count)
+            self.error_trace.append((count, error))
+            if display_progress:
+                sys.stderr.write('\r'); sys.stderr.write('lexicon %s, standard error %.5f' % (count, error)) ; sys.stderr.flush()
+            if count >= min_samples and error <= target_error:
+                break
+        if count == 0:
+            raise ValueError("No lexica were drawn from the iterator")
+        self.lexcount = count
+        self.final_listener = sums['U'] / sums['Y']
+        self.store_marginal()
+        self.iterate(n, tolerance=tolerance, trace=trace)
+        return count >= min_samples and error <= target_error
+
+    def listener_error(self, sums, count):
+        """Standard errors of the sampled listener U/Y (summed over the
+        draws, as run_sampled keeps them) by the delta method: each draw's
+        influence on an entry is (U - listener * Y) / mean(Y), and the sums
+        of squares of these come from the running sums of U**2, U*Y and
+        Y**2, so the draws themselves needn't be kept."""
+        if count < 2:
+            return np.zeros(sums['U'].shape) + np.inf
+        lis = sums['U'] / sums['Y']
+        squares = sums['UU'] - 2 * lis * sums['UY'] + lis**2 * sums['YY']
+        # Rounding can leave tiny negative values where the influence vanishes:
+        squares = np.maximum(squares, 0.0) / (sums['Y'] / count)**2
+        return np.sqrt(squares / (count * (count - 1)))
+
+    def iterate(self, n, tolerance=None, trace=False, start=None):
+        """Up to n further rounds of S and L with no lexical uncertainty,
+        from final_listener or, if start is given, from the listener at that
+        depth: 0 is the lexical uncertainty listener, stored by run, so the
+        lexica needn't be marginalized again, and deeper ones come from the
+        trace (see restore, which raises ValueError if they aren't there or
+        the settings have changed). With a tolerance, stops as soon as no entry of the listener
+        changes by more than it, and sets self.converged. With trace, the
+        listener at each depth d reached is kept in listener_trace[d] and
+        the speaker reasoning about it in speaker_trace[d]; these are
+        preallocated for n more depths and trimmed afterwards. Returns
+        self.converged."""
+        if start is not None:
+            self.restore(start)
+        if trace:
+            # Preallocated stacks, keeping whatever is known up to the current depth:
+            listeners = np.zeros((self.depth+n+1,) + self.final_listener.shape) + np.nan
+            speakers = np.zeros((self.depth+n,) + self.final_listener.shape[::-1]) + np.nan
+            if self.listener_trace is not None:
+                known = min(len(self.listener_trace), self.depth+1)
+                listeners[: known] = self.listener_trace[: known]
+                speakers[: known-1] = self.speaker_trace[: known-1]
+            listeners[self.depth] = self.final_listener
+        self.converged = False if tolerance is not None else None
+        for i in range(n):
+            speaker = self.S(self.final_listener)
+            with np.errstate(invalid='ignore'):
+                listener = self.L(speaker)
+            # At high temperatures, all of a message's speaker probabilities
+            # can underflow to 0; its row then comes from the log domain:
+            underflowed = ~np.all(np.isfinite(listener), axis=1)
+            if np.any(underflowed):
+                listener[underflowed] = np.exp(self.log_L(self.log_S(safelog(self.final_listener)))[underflowed])
+            change = np.max(np.abs(listener - self.final_listener))
+            self.final_speaker, self.final_listener = speaker, listener
+            self.depth += 1
+            if trace:
+                speakers[self.depth-1] = speaker
+                listeners[self.depth] = listener
+            if tolerance is not None and change <= tolerance:
+                self.converged = True
+                break
+        if trace:
+            self.listener_trace = listeners[: self.depth+1]
+            self.speaker_trace = speakers[: self.depth]
+        return self.converged
+
+    def store_marginal(self):
+        """Keeps final_listener as the lexical uncertainty listener that
+        iterate restarts from, along with the temperature and costs it was
+        computed with, and drops the speaker and traces of the old one."""
+        self.marginal_listener = self.final_listener.copy()
+        self.marginal_settings = (self.temperature, np.array(self.costs, dtype=float))
+        self.final_speaker = None
+        self.depth = 0
+        self.listener_trace = None
+        self.speaker_trace = None
+
+    def restore(self, depth):
+        """Makes the listener at depth (and the speaker it comes from) final
+        again, provided the temperature and costs haven't changed since it
+        was computed."""
+        if self.marginal_settings is None:
+            raise ValueError("No lexical uncertainty listener is stored; run the model first")
+        temperature, costs = self.marginal_settings
+        if temperature != self.temperature or not np.array_equal(costs, self.costs):
+            raise ValueError("The stored listeners were computed with another temperature or other costs; run the model again")
+        if depth == 0 and self.marginal_listener is not None:
+            self.final_listener = self.marginal_listener.copy()
+            self.final_speaker = None
+        elif self.listener_trace is not None and depth < len(self.listener_trace) and not np.any(np.isnan(self.listener_trace[depth])):
+            self.final_listener = self.listener_trace[depth].copy()
+            self.final_speaker = self.speaker_trace[depth-1].copy() if depth else None
+        else:
+            raise ValueError("The listener at depth %s isn't stored; iterate with trace=True to keep it" % depth)
+        self.depth = depth
+
+    def sweep(self, temperatures, costs=None, batch_size=100, dedup=False, display_progress=True):
+        """Lexical uncertainty listeners for every combination of a
+        temperature in temperatures and a cost vector in costs (default:
+        just self.costs), from a single pass through the lexica. Each batch
+        of lexica goes through l0 once, and S is then computed for the whole
+        grid at once by broadcasting over a leading parameter axis, so memory
+        is proportional to batch_size times the size of the grid. Returns a
+        SweepResult."""
+        temperatures = np.array(temperatures, dtype=float)
+        costs = np.array([self.costs] if costs is None else costs, dtype=float)
+        m, n = len(self.messages), len(self.states)
+        # Flattened grid, shaped to broadcast against (batch, states, messages) speakers:
+        grid_temperatures = np.repeat(temperatures, len(costs))[:, np.newaxis, np.newaxis, np.newaxis]
+        grid_costs = np.tile(costs, (len(temperatures), 1))[:, np.newaxis, np.newaxis, :]
+        lexica = self.weighted_lexica(display_progress=display_progress)
+        if dedup:
+            lexica, _ = self.deduplicate(lexica)
+        totals = np.zeros((len(temperatures)*len(costs), m, n))
+        logtotals = np.zeros(totals.shape) - np.inf
+        for batch in batches(lexica, batch_size):
+            weights, stack = zip(*batch)
+            weights = np.array(weights)
+            # The utilities of S, exponentiated as S does and also normalized
+            # in the log domain for the rows that underflow (see speaker_sum):
+            utility = grid_temperatures * (safelog(transpose(self.l0(np.array(stack)))) - grid_costs)
+            spk = expnorm(utility)
+            totals += np.einsum('b,pbnm->pmn', weights, spk)
+            logspk = lognorm(utility, out=utility)
+            logspk += safelog(weights)[:, np.newaxis, np.newaxis]
+            np.logaddexp(logtotals, transpose(logsumexp(logspk, axis=1)), out=logtotals)
+        listeners = self.normalize_marginal(totals, logtotals)
+        return SweepResult(listeners.reshape(len(temperatures), len(costs), m, n),
+                           temperatures, costs, self.messages, self.states)
+
+    def weighted_lexica(self, display_progress=True):
+        """(lexicon prior value, lexicon) pairs for all the lexica."""
         # If there is no lexicon prior, then this allows us to ignore it.
         lexprior_func = (lambda x : 1.0)
         # Where we have a lexicon prior, we can look up the value in self.lexprior:
-        if self.lexprior != None:
+        if self.lexprior is not None:
             lexprior_func = (lambda lexindex : self.lexprior[lexindex])
-        # Iterate through the lexica:
-        for lexindex, lex in enumerate(self.lexicon_iterator()):
+        lexica = self.progress(self.lexicon_iterator(), display_progress=display_progress)
+        return ((lexprior_func(lexindex), lex) for lexindex, lex in enumerate(lexica))
+
+    def speaker_sum(self, weighted_lexica, batch_size=None):
+        """Sum of weight * S(l0(lex)).T over the (weight, lex) pairs, the
+        same sum accumulated in the log domain, and the number of pairs.
+        At high temperatures, the speaker probabilities of costly messages
+        like NULL underflow to 0 for every lexicon, and the log sum is what
+        normalize_marginal falls back on for them. With batch_size, the
+        pairs are taken in stacks of that size and each stack is handled by
+        one tensordot."""
+        total = np.zeros((len(self.messages), len(self.states)))
+        logtotal = np.zeros(total.shape) - np.inf
+        count = 0
+        # The speakers are computed in the same preallocated buffers throughout:
+        work = self.workspace(batch_size)
+        if batch_size:
+            for batch in batches(weighted_lexica, batch_size):
+                weights, lexica = zip(*batch)
+                weights = np.array(weights)
+                # Weighted sum of the speakers over the batch axis, transposed to (messages, states):
+                total += np.tensordot(weights, self.speaker_into(np.array(lexica), work), axes=1).T
+                logspk = work['logspk'][: len(batch)]
+                logspk += safelog(weights)[:, np.newaxis, np.newaxis]
+                np.logaddexp(logtotal, logsumexp(logspk, axis=0).T, out=logtotal)
+                count += len(batch)
+        else:
+            for weight, lex in weighted_lexica:
+                spk = self.speaker_into(lex, work)
+                spk *= weight
+                total += spk.T
+                np.logaddexp(logtotal, work['logspk'].T + safelog(weight), out=logtotal)
+                count += 1
+        return total, logtotal, count
+
+    def normalize_marginal(self, total, logtotal):
+        """The listener rownorm(stateprior * total) for the marginal total
+        of the speakers, except in rows where every entry of total has
+        underflowed to 0, which are normalized from the log-domain sum
+        logtotal instead. total and logtotal may be stacks of marginals."""
+        with np.errstate(invalid='ignore'):
+            lis = rownorm(self.stateprior * total)
+        underflowed = ~np.all(np.isfinite(lis), axis=-1)
+        lis[underflowed] = np.exp(lognorm(logtotal[underflowed] + safelog(self.stateprior)))
+        return lis
+
+    def sparse_speaker_sum(self, lexica, block_size=1000, display_progress=True):
+        """speaker_sum for the SparseLexica lexica, weighted by the lexicon
+        prior if there is one. The kernels of SparseEntries compute l0 and
+        S only at the true entries of each block of block_size lexica."""
+        total = np.zeros((len(self.messages), len(self.states)))
+        logtotal = np.zeros(total.shape) - np.inf
+        for start in range(0, len(lexica), block_size):
+            entries = lexica.entries(start, start+block_size)
+            if self.lexprior is not None:
+                weights = np.asarray(self.lexprior[start: start+block_size], dtype=float)
+            else:
+                weights = np.ones(entries.shape[0])
+            logspk = entries.log_S(entries.l0(self.stateprior), self.temperature, self.costs)
+            total += entries.marginal(np.exp(logspk), weights)
+            np.logaddexp(logtotal, entries.log_marginal(logspk, weights), out=logtotal)
+            if display_progress:
+                sys.stderr.write('\r'); sys.stderr.write('lexicon %s' % (start+entries.shape[0])) ; sys.stderr.flush()
+        return total, logtotal, len(lexica)
+
+    def deduplicate(self, weighted_lexica):
+        """Collapses the (weight, lex) pairs whose interpretation matrices
+        are identical into a single pair carrying the sum of their weights,
+        in order of first appearance. The weighted marginal is unchanged,
+        since identical lexica have identical speakers. Returns the distinct
+        pairs and the number of lexica read."""
+        weights = {}
+        distinct = []
+        count = 0
+        for weight, lex in weighted_lexica:
+            key = lex.tostring()
+            if key not in weights:
+                weights[key] = 0.0
+                distinct.append((key, lex))
+            weights[key] += weight
+            count += 1
+        return [(weights[key], lex) for key, lex in distinct], count
+
+    def progress(self, lexica, display_progress=True):
+        """Passes the lexica through, reporting the count on stderr."""
+        for lexindex, lex in enumerate(lexica):
             if display_progress and lexindex and lexindex % 10**2 == 0:
                 sys.stderr.write('\r'); sys.stderr.write('lexicon %s' % lexindex) ; sys.stderr.flush()
-            self.final_listener += lexprior_func(lexindex) * self.S(self.l0(lex)).T            
-        # Update or fill in the lexcount based on the iteration:
-        self.lexcount = lexindex + 1
-        # Final normalization and state prior incorporation:
-        self.final_listener = rownorm( self.stateprior * self.final_listener)
-        # Optional further iteration of L and S with no lexical uncertainty:
-        for i in range(n):
-            self.final_speaker = self.S(self.final_listener)
-            self.final_listener = self.L(self.final_speaker)
+            yield lex
+
+    def run_parallel(self, processes, block_size, batch_size=None, dedup=False, display_progress=True):
+        """Adds the lexica to self.final_listener using a pool of processes,
+        returning the log-domain marginal (see speaker_sum) and the number
+        of lexica seen. The lexicon space is cut into
+        consecutive index ranges of block_size, each worker sums the
+        speakers for the blocks it is handed, and the partial sums are
+        added here in block order. Since the blocks don't depend on the
+        number of processes, neither does the result."""
+        global _pool_model
+        if self.lexprior is not None:
+            raise ValueError("The lexicon prior is indexed by the filtered lexica, which the workers can't know; processes requires a flat lexicon prior")
+        if self.lexicon_space_size is None:
+            raise ValueError("processes requires lexicon_space_size and a lexicon_iterator accepting start and stop indices")
+        blocks = [(start, min(start+block_size, self.lexicon_space_size), batch_size, dedup)
+                  for start in range(0, self.lexicon_space_size, block_size)]
+        lexcount = 0
+        logmarginal = np.zeros(self.final_listener.shape) - np.inf
+        _pool_model = self
+        pool = multiprocessing.Pool(processes)
+        try:
+            for blockindex, (partial, logpartial, count) in enumerate(pool.imap(_pool_partial_marginal, blocks)):
+                if display_progress:
+                    sys.stderr.write('\r'); sys.stderr.write('block %s of %s' % (blockindex+1, len(blocks))) ; sys.stderr.flush()
+                self.final_listener += partial
+                np.logaddexp(logmarginal, logpartial, out=logmarginal)
+                lexcount += count
+            pool.close()
+        finally:
+            pool.terminate()
+            _pool_model = None
+        return logmarginal, lexcount
+
+    def partial_marginal(self, start, stop, batch_size=None, dedup=False):
+        """Unweighted sum of the transposed speakers for the lexica in the
+        index range [start, stop) of the lexicon space, the same sum in the
+        log domain, and the number of lexica that survived the iterator's
+        filtering. With dedup, the duplicates within the range are
+        collapsed."""
+        lexica = ((1.0, lex) for lex in self.lexicon_iterator(start, stop))
+        if dedup:
+            lexica, count = self.deduplicate(lexica)
+            partial, logpartial, _ = self.speaker_sum(lexica, batch_size=batch_size)
+        else:
+            partial, logpartial, count = self.speaker_sum(lexica, batch_size=batch_size)
+        return partial, logpartial, count
 
     def l0(self, lex):
-        """Literal listener normalizing the boolean lexicon and incorporating the prior."""
+        """Literal listener normalizing the boolean lexicon and incorporating the prior.
+        Applies also to stacks of lexica of shape (batch, messages, states)."""
         return rownorm(lex * self.stateprior)    
 
     def L(self, spk):
         """The general listener differs from l0 only in transposing the incoming speaker matrix."""
-        return self.l0(spk.T)
+        return self.l0(transpose(spk))
+
+    def S(self, lis, temperature=None, costs=None):
+        """Bayesian speaker incorporating costs. temperature and costs default
+        to the model's own; arrays with extra leading axes give speakers for
+        many settings at once."""
+        if temperature is None:
+            temperature = self.temperature
+        if costs is None:
+            costs = self.costs
+        # Rows that would underflow are shifted (see expnorm), so high temperatures don't give nan:
+        return expnorm(temperature * (safelog(transpose(lis)) - costs))
+
+    def log_L(self, logspk, out=None):
+        """log L(exp(logspk)) from the log speaker."""
+        return lognorm(transpose(logspk) + safelog(self.stateprior), out=out)
 
-    def S(self, lis):
-        """Bayesian speaker incorporating costs."""
-        return rownorm(np.exp(self.temperature * (safelog(lis.T) - self.costs)))
+    def log_S(self, loglis, temperature=None, costs=None, out=None):
+        """log S(exp(loglis)) from the log listener, normalized by logsumexp."""
+        if temperature is None:
+            temperature = self.temperature
+        if costs is None:
+            costs = self.costs
+        return lognorm(temperature * (transpose(loglis) - costs), out=out)
+
+    def workspace(self, batch_size=None):
+        """Buffers for speaker_into, for single lexica or for stacks of up
+        to batch_size."""
+        lead = (batch_size,) if batch_size else ()
+        m, n = len(self.messages), len(self.states)
+        return {'l0': np.empty(lead + (m, n)), 'messages': np.empty(lead + (m, 1)),
+                'spk': np.empty(lead + (n, m)), 'logspk': np.empty(lead + (n, m)), 'states': np.empty(lead + (n, 1))}
+
+    def speaker_into(self, lex, work):
+        """S(l0(lex)), as (states, messages), for a lexicon or a stack of
+        them, computed entirely inside the buffers of work (from
+        self.workspace) and returned in a view of work['spk']. The steps
+        are those of l0 and S, so the results are identical to theirs. The
+        log speaker, which stays finite where the speaker underflows, is
+        left in work['logspk']."""
+        size = len(lex) if lex.ndim == 3 else None
+        lis, messages, spk, logspk, states = [work[key][: size] if size else work[key] for key in ('l0', 'messages', 'spk', 'logspk', 'states')]
+        # The literal listener:
+        np.multiply(lex, self.stateprior, out=lis)
+        np.sum(lis, axis=-1, keepdims=True, out=messages)
+        lis /= messages
+        # The speaker's utilities:
+        with np.errstate(divide='ignore'):
+            np.log(transpose(lis), out=spk)
+        spk -= self.costs
+        spk *= self.temperature
+        np.copyto(logspk, spk)
+        lognorm(logspk, out=logspk)
+        return expnorm(spk, out=spk, work=states)
 
     def listener_report(self, digits=4):
         print "=" * 70 # Divider bar.
@@ -128,6 +582,31 @@ class LexicalUncertaintyModel:
      
 ######################################################################
 
+class SweepResult:
+    """Lexical uncertainty listeners from LexicalUncertaintyModel.sweep.
+    values has shape (temperatures, costs, messages, states), and the
+    other attributes label those axes."""
+    def __init__(self, values, temperatures, costs, messages, states):
+        self.values = values
+        self.temperatures = temperatures
+        self.costs = costs
+        self.messages = messages
+        self.states = states
+
+    def listener(self, temperature, costs):
+        """The listener matrix for one grid point."""
+        i = np.flatnonzero(np.isclose(self.temperatures, temperature))[0]
+        j = np.flatnonzero(np.all(np.isclose(self.costs, costs), axis=1))[0]
+        return self.values[i, j]
+
+    def settings(self):
+        """Iterates over (temperature, cost vector, listener) triples."""
+        for i, temperature in enumerate(self.temperatures):
+            for j, costs in enumerate(self.costs):
+                yield temperature, costs, self.values[i, j]
+
+######################################################################
+
 if __name__ == '__main__':
 
     def manner_example():
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import hashlib
+import tempfile
+import numpy as np
+
+######################################################################
+
+class LexiconCache:
+    """Content-addressed store of the lexica of UncertaintyGrammars.
+    The lexica of a grammar are saved as one boolean .npy tensor of shape
+    (lexica, messages, worlds) whose name is a hash of everything that
+    determines them: the baselexicon (and with it the players and shots),
+    the worlds, the messages and formulae, the refinable specification
+    and the semantics module. Tensors are loaded memory-mapped, and the
+    least recently used ones are deleted whenever the directory grows
+    beyond max_bytes."""
+    def __init__(self, cache_dir="../cache/lexica", max_bytes=10**9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def lexica(self, grammar, display_progress=True):
+        """The tensor of the grammar's lexica, enumerated and stored on the
+        first request and read back memory-mapped after that."""
+        filename = self.filename(grammar)
+        if not os.path.exists(filename):
+            tensor = self.enumerate(grammar)
+            self.store(filename, tensor)
+            if display_progress:
+                sys.stderr.write("Cached %s lexica in %s\n" % (len(tensor), filename))
+        # Mark as recently used for the eviction policy:
+        os.utime(filename, None)
+        return np.load(filename, mmap_mode='r')
+
+    def enumerate(self, grammar, chunk_size=1024):
+        """The grammar's lexica as a boolean tensor, filled in as they are
+        enumerated, so that only one float matrix exists at a time. The
+        number of lexica isn't known in advance, so the tensor starts with
+        room for chunk_size of them and doubles whenever it fills up."""
+        tensor = np.zeros((chunk_size, len(grammar.messages), len(grammar.worlds)), dtype=bool)
+        count = 0
+        for mat in grammar.enumerate_lexica():
+            if count == len(tensor):
+                grown = np.zeros((2*len(tensor),) + tensor.shape[1: ], dtype=bool)
+                grown[: count] = tensor
+                tensor = grown
+            tensor[count] = mat
+            count += 1
+        return tensor[: count]
+
+    def filename(self, grammar):
+        return os.path.join(self.cache_dir, "%s.npy" % self.key(grammar))
+
+    def key(self, grammar):
+        digest = hashlib.sha1()
+        spec = [grammar.semantics.__name__,
+                grammar.baselexicon,
+                grammar.worlds,
+                zip(grammar.messages, grammar.formulae),
+                grammar.refinable,
+                grammar.nullmsg]
+        update_digest(digest, spec)
+        return digest.hexdigest()
+
+    def store(self, filename, tensor):
+        # Write to a temporary file first so that other processes never see a partial tensor:
+        handle, tmpname = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            np.save(f, tensor)
+        os.rename(tmpname, filename)
+        self.evict(keep=filename)
+
+    def evict(self, keep=None):
+        """Deletes the least recently used tensors until the cache is within max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.npy'):
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+def update_digest(digest, obj):
+    """Feeds a canonical serialization of obj into digest. Dictionaries are
+    taken in sorted order and arrays by dtype, shape and contents, since
+    their repr elides large arrays."""
+    if isinstance(obj, dict):
+        digest.update('{')
+        for key in sorted(obj):
+            update_digest(digest, key)
+            update_digest(digest, obj[key])
+        digest.update('}')
+    elif isinstance(obj, (list, tuple)):
+        digest.update('[')
+        for x in obj:
+            update_digest(digest, x)
+        digest.update(']')
+    elif isinstance(obj, np.ndarray):
+        digest.update('array%s%s' % (obj.dtype.str, obj.shape))
+        digest.update(np.ascontiguousarray(obj).tostring())
+    else:
+        digest.update(repr(obj))
+    digest.update(',')
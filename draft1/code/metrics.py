@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Fit statistics for many pairs of vectors at once. The vectors are the
+# last axis of the arguments, which broadcast against each other, so that
+# e.g. a (models, messages, worlds) stack of listeners can be compared
+# with a (messages, worlds) matrix of human responses in one call.
+
+import numpy as np
+from scipy import stats
+
+######################################################################
+
+METRICS = ('pearson', 'pearson_p', 'spearman', 'spearman_p', 'mse')
+
+def fit_metrics(x, y):
+    """Record array, with the fields in METRICS and the broadcast shape of
+    x and y without their last axis, of the Pearson and Spearman
+    correlations of x and y along that axis, their two-sided p values,
+    and the root mean squared error (utils.mse)."""
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    n = x.shape[-1]
+    r = pearson(x, y)
+    rho = pearson(rankdata(x), rankdata(y))
+    return np.rec.fromarrays([r, correlation_p(r, n), rho, correlation_p(rho, n), rmse(x, y)], names=METRICS)
+
+def pearson(x, y):
+    """Pearson correlations of x and y along the last axis; nan where
+    either is constant."""
+    xm = x - np.mean(x, axis=-1)[..., np.newaxis]
+    ym = y - np.mean(y, axis=-1)[..., np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.sum(xm * ym, axis=-1) / np.sqrt(np.sum(xm**2, axis=-1) * np.sum(ym**2, axis=-1))
+    # Rounding can take |r| just past 1:
+    return np.clip(r, -1.0, 1.0)
+
+def correlation_p(r, n):
+    """Two-sided p values of correlations r over n points, from the t
+    distribution with n-2 degrees of freedom, as scipy.stats computes
+    them for pearsonr and spearmanr."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = r * np.sqrt((n - 2) / ((1.0 - r) * (1.0 + r)))
+    return 2 * stats.t.sf(np.abs(t), n - 2)
+
+def rmse(x, y):
+    return np.sqrt(np.mean((x - y)**2, axis=-1))
+
+def rankdata(x):
+    """Ranks of x along the last axis, starting at 1, with ties given the
+    average of their ranks, like scipy.stats.rankdata for every vector at
+    once."""
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-1]
+    rows = x.reshape((-1, n))
+    order = np.argsort(rows, axis=1, kind='mergesort')
+    ordered = np.take_along_axis(rows, order, axis=1)
+    # Number the runs of tied values consecutively across all the rows:
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[:, 1: ] = ordered[:, 1: ] != ordered[:, : -1]
+    runs = np.cumsum(starts).reshape(ordered.shape) - 1
+    # Each run's rank is the mean of its positions:
+    positions = np.tile(np.arange(1.0, n+1), len(rows))
+    average = np.bincount(runs.ravel(), weights=positions) / np.bincount(runs.ravel())
+    ranks = np.zeros(rows.shape)
+    np.put_along_axis(ranks, order, average[runs], axis=1)
+    return ranks.reshape(x.shape)
@@ -3,6 +3,8 @@
 from copy import copy
 from iterative_lexical_uncertainty import LexicalUncertaintyModel
 from grammar import UncertaintyGrammars
+from lexicon_cache import LexiconCache
+from experiment_cache import ExperimentCache
 from utils import display_matrix
 from experiment import *
 from fragment import *
@@ -107,14 +109,17 @@ def complex_example():
 def experiment_plot_and_report(
         src_filename='../data/basketball-pilot-2-11-14-results-parsed.csv',
         output_filename="../fig/basketball-pilot-2-11-14-results-parsed.pdf"):
-    exp = Experiment(src_filename=src_filename)
+    exp = ColumnarExperiment(src_filename=src_filename)
     exp.experimental_report()
     exp.plot_targets(output_filename=output_filename)
 
 ######################################################################
     
 def experimental_assessment(experiment_src="../data/basketball-pilot-2-11-14-results-parsed.csv",
-                            plot_output_filename='../fig/allmodels.pdf'):
+                            plot_output_filename='../fig/allmodels.pdf',
+                            processes=None,
+                            cache_dir=None,
+                            experiment_cache_dir=None):
     # General settings:
     subjs= ('every_player', 'exactly_one_player', 'no_player')
     objs = ('every_shot', 'no_shot', 'some_shot')
@@ -127,6 +132,8 @@ def experimental_assessment(experiment_src="../data/basketball-pilot-2-11-14-res
     nullmsg = True
     nullcost = 5.0       
     worldnames = [worldname(w) for w in worlds]
+    # Reuse the lexica enumerated on earlier runs where possible:
+    cache = LexiconCache(cache_dir) if cache_dir else None
     messages = []
     for d1, d2 in product(subjs, objs):
         subj = d1.replace("_player", "(player)")
@@ -141,10 +148,12 @@ def experimental_assessment(experiment_src="../data/basketball-pilot-2-11-14-res
         messages=copy(messages),
         worlds=copy(worlds),        
         refinable={'some_player': [], 'some_shot': []},
-        nullmsg=nullcost)
+        nullmsg=nullcost,
+        cache=cache)
     ucmod = LexicalUncertaintyModel(
         name="Unconstrained",
         lexicon_iterator=ucgram.lexicon_iterator,
+        lexicon_space_size=ucgram.lexicon_space_size(),
         baselexicon=ucgram.baselexicon_mat,
         messages=ucgram.messages,
         states=worldnames,
@@ -158,10 +167,12 @@ def experimental_assessment(experiment_src="../data/basketball-pilot-2-11-14-res
         messages=copy(messages),
         worlds=copy(worlds),        
         refinable={'some_player': ['exactly_one_player'], 'some_shot': ['exactly_one_shot']},
-        nullmsg=nullcost)    
+        nullmsg=nullcost,
+        cache=cache)    
     neomod = LexicalUncertaintyModel(
         name="Neo-Gricean",
         lexicon_iterator=neogram.lexicon_iterator,
+        lexicon_space_size=neogram.lexicon_space_size(),
         baselexicon=neogram.baselexicon_mat,
         messages=neogram.messages,
         states=worldnames,
@@ -169,12 +180,18 @@ def experimental_assessment(experiment_src="../data/basketball-pilot-2-11-14-res
         nullmsg=nullmsg,
         nullcost=nullcost)
     
-    # Run the models, going only to the first uncertainty listener (n=0):
-    ucmod.run(n=0)
-    neomod.run(n=0)
+    # Run the models, going only to the first uncertainty listener (n=0),
+    # optionally spreading the lexica over a pool of processes:
+    ucmod.run(n=0, processes=processes)
+    neomod.run(n=0, processes=processes)
         
-    # The analysis:
-    analysis = Analysis(experiment=Experiment(experiment_src), models=[ucmod, neomod])    
+    # The analysis, against the pooled responses if several files are given:
+    experiment_cache = ExperimentCache(experiment_cache_dir) if experiment_cache_dir else None
+    if isinstance(experiment_src, basestring):
+        experiment = ColumnarExperiment(experiment_src, cache=experiment_cache)
+    else:
+        experiment = PooledExperiment(experiment_src, cache=experiment_cache)
+    analysis = Analysis(experiment=experiment, models=[ucmod, neomod])    
     analysis.overall_analysis()
     analysis.analysis_by_message()
     analysis.comparison_plot(output_filename=plot_output_filename)
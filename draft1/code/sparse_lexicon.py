@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy import sparse
+
+######################################################################
+
+class SparseLexica:
+    """A collection of boolean lexica of shape (messages, worlds) held as
+    one scipy.sparse CSR matrix whose rows are the lexica's messages in
+    turn: lexicon i has rows i*messages to (i+1)*messages. Memory is
+    proportional to the number of true entries rather than to the number
+    of cells, and the kernels of SparseEntries only touch those entries."""
+    def __init__(self, matrix, messages):
+        self.matrix = matrix
+        self.messages = messages
+        self.worlds = matrix.shape[1]
+
+    @classmethod
+    def from_dense(cls, lexica, messages, worlds, chunk_size=1000):
+        """Builds the collection from an iterator of dense matrices, as
+        given by lexicon_iterator, holding at most chunk_size of them
+        densely at a time."""
+        rows = []
+        cols = []
+        count = 0
+        chunk = []
+        for lex in lexica:
+            chunk.append(lex)
+            if len(chunk) == chunk_size:
+                count = cls.add_chunk(chunk, count, rows, cols)
+                chunk = []
+        if chunk:
+            count = cls.add_chunk(chunk, count, rows, cols)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32)
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=count*messages))))
+        matrix = sparse.csr_matrix((np.ones(len(cols), dtype=bool), cols, indptr), shape=(count*messages, worlds))
+        return cls(matrix, messages)
+
+    @staticmethod
+    def add_chunk(chunk, count, rows, cols):
+        # np.nonzero runs in row-major order, so the entries stay sorted by row:
+        lexicon, message, world = np.nonzero(np.array(chunk))
+        rows.append((count + lexicon) * chunk[0].shape[0] + message)
+        cols.append(world.astype(np.int32))
+        return count + len(chunk)
+
+    def __len__(self):
+        return self.matrix.shape[0] // self.messages
+
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+
+    def dense(self, i):
+        """The interpretation matrix of lexicon i."""
+        return self.matrix[i*self.messages: (i+1)*self.messages].toarray().astype(float)
+
+    def entries(self, start=0, stop=None):
+        """SparseEntries for lexica start to stop."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        first, last = start * self.messages, stop * self.messages
+        indptr = self.matrix.indptr
+        rows = np.repeat(np.arange(last - first), np.diff(indptr[first: last+1]))
+        lexicon, message = np.divmod(rows, self.messages)
+        world = self.matrix.indices[indptr[first]: indptr[last]]
+        return SparseEntries(lexicon, message, world, (stop - start, self.messages, self.worlds))
+
+######################################################################
+
+class SparseEntries:
+    """The true entries of a stack of lexica of the given shape (lexica,
+    messages, worlds), as parallel index arrays. A literal listener, a
+    speaker or a listener derived from the stack is zero wherever the
+    lexicon is false, so these kernels represent each of them by its
+    values at the entries alone. Speakers are indexed like the listeners
+    they come from, i.e., by (lexicon, message, world) rather than
+    transposed."""
+    def __init__(self, lexicon, message, world, shape):
+        self.lexicon = lexicon
+        self.message = message
+        self.world = world
+        self.shape = shape
+        count, m, n = shape
+        # Entries grouped by (lexicon, message), the rows normalized by l0 and L:
+        self.message_groups = lexicon * m + message
+        # and by (lexicon, world), the rows normalized by S; the max-shift
+        # needs each group contiguous, so the order is kept:
+        keys = lexicon * n + world
+        self.world_order = np.argsort(keys, kind='mergesort')
+        firsts = np.ones(len(keys), dtype=bool)
+        firsts[1: ] = keys[self.world_order][1: ] != keys[self.world_order][: -1]
+        self.world_starts = np.flatnonzero(firsts)
+        self.world_groups = np.empty(len(keys), dtype=int)
+        self.world_groups[self.world_order] = np.cumsum(firsts) - 1
+
+    def l0(self, stateprior):
+        """Values of the literal listeners: each lexicon's rows times the state prior, normalized."""
+        vals = stateprior[self.world]
+        return vals / np.bincount(self.message_groups, weights=vals)[self.message_groups]
+
+    def L(self, spk, stateprior):
+        """Values of the listeners reasoning about the speakers spk."""
+        vals = spk * stateprior[self.world]
+        return vals / np.bincount(self.message_groups, weights=vals)[self.message_groups]
+
+    def S(self, lis, temperature, costs):
+        """Values of the speakers reasoning about the listeners lis."""
+        return np.exp(self.log_S(lis, temperature, costs))
+
+    def log_S(self, lis, temperature, costs):
+        """Logs of the values of S, with the softmax over messages shifted
+        by each state's best utility; unlike the values, these stay finite
+        at high temperatures."""
+        utility = temperature * (np.log(lis) - costs[self.message])
+        shift = np.maximum.reduceat(utility[self.world_order], self.world_starts)
+        utility -= shift[self.world_groups]
+        return utility - np.log(np.bincount(self.world_groups, weights=np.exp(utility)))[self.world_groups]
+
+    def marginal(self, spk, weights):
+        """Sum over the lexica of weights times the speakers, as a dense
+        (messages, worlds) matrix (that is, transposed like
+        LexicalUncertaintyModel.speaker_sum's)."""
+        count, m, n = self.shape
+        return np.bincount(self.message * n + self.world, weights=weights[self.lexicon] * spk, minlength=m*n).reshape((m, n))
+
+    def log_marginal(self, logspk, weights):
+        """The log of marginal, from the log speakers logspk, with every
+        (message, world) cell accumulated by logaddexp."""
+        count, m, n = self.shape
+        total = np.zeros(m*n) - np.inf
+        with np.errstate(divide='ignore'):
+            np.logaddexp.at(total, self.message * n + self.world, logspk + np.log(weights[self.lexicon]))
+        return total.reshape((m, n))
+
+    def dense(self, vals):
+        """The (lexica, messages, worlds) array with vals at the entries."""
+        mat = np.zeros(self.shape)
+        mat[self.lexicon, self.message, self.world] = vals
+        return mat
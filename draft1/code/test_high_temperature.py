@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Checks that the lexical uncertainty listeners of the paper's grammars
+stay finite at high temperatures, where the NULL message's speaker
+probabilities underflow to 0 in every lexicon, and that the different
+ways of computing them agree. Run directly, or with pytest."""
+
+from copy import copy
+from itertools import product
+import numpy as np
+from iterative_lexical_uncertainty import LexicalUncertaintyModel
+from grammar import UncertaintyGrammars
+from fragment import *
+
+######################################################################
+
+TEMPERATURES = (3.0, 150.0, 400.0)
+DEPTHS = (0, 3)
+TOLERANCE = 1e-10
+
+REFINABLE = {
+    'Unconstrained': {'some_player': [], 'some_shot': []},
+    'Neo-Gricean': {'some_player': ['exactly_one_player'], 'some_shot': ['exactly_one_shot']}}
+
+def paper_grammar(refinable):
+    """The UncertaintyGrammars of paper.experimental_assessment."""
+    subjs = ('every_player', 'exactly_one_player', 'no_player')
+    objs = ('every_shot', 'no_shot', 'some_shot')
+    worlds = get_worlds(basic_states=(0,1,2), length=3, increasing=True)
+    baselexicon = define_lexicon(player=[a,b,c], shot=[s1,s2], worlds=worlds)
+    messages = [("%s %s" % (d1, d2), "iv(%s, tv(hit, %s, self.worlds, player))" % (d1, d2)) for d1, d2 in product(subjs, objs)]
+    return UncertaintyGrammars(baselexicon=baselexicon, messages=messages, worlds=worlds, refinable=copy(refinable), nullmsg=True)
+
+def paper_model(gram, temperature):
+    """A fresh model for gram, since run adds into final_listener."""
+    return LexicalUncertaintyModel(
+        lexicon_iterator=gram.lexicon_iterator,
+        baselexicon=gram.baselexicon_mat,
+        messages=gram.messages,
+        states=[worldname(w) for w in gram.worlds],
+        temperature=temperature,
+        nullmsg=True,
+        nullcost=5.0)
+
+def check_listeners(name, refinable):
+    gram = paper_grammar(refinable)
+    variants = [{}, {'batch_size': 100}, {'dedup': True}, {'sparse_lexica': gram.sparse_lexica()}]
+    for temperature in TEMPERATURES:
+        sweep = paper_model(gram, temperature).sweep([1.0, temperature], display_progress=False)
+        for n in DEPTHS:
+            listeners = []
+            for kwargs in variants:
+                mod = paper_model(gram, temperature)
+                mod.run(n=n, display_progress=False, **kwargs)
+                assert np.all(np.isfinite(mod.final_listener)), \
+                    "%s: nan listener at temperature %s, depth %s, with %s" % (name, temperature, n, sorted(kwargs))
+                listeners.append(mod.final_listener)
+            for kwargs, lis in zip(variants[1: ], listeners[1: ]):
+                np.testing.assert_allclose(lis, listeners[0], rtol=0, atol=TOLERANCE,
+                                           err_msg="%s: run with %s at temperature %s, depth %s" % (name, sorted(kwargs), temperature, n))
+            if n == 0:
+                np.testing.assert_allclose(sweep.values[1, 0], listeners[0], rtol=0, atol=TOLERANCE,
+                                           err_msg="%s: sweep at temperature %s" % (name, temperature))
+
+def test_unconstrained():
+    check_listeners('Unconstrained', REFINABLE['Unconstrained'])
+
+def test_neo_gricean():
+    check_listeners('Neo-Gricean', REFINABLE['Neo-Gricean'])
+
+def test_sampled():
+    # The sampled listener should be finite, and within a few of its
+    # standard errors of the exact one:
+    gram = paper_grammar(REFINABLE['Unconstrained'])
+    for temperature in TEMPERATURES:
+        exact = paper_model(gram, temperature)
+        exact.run(display_progress=False)
+        mod = paper_model(gram, temperature)
+        assert mod.run_sampled(gram.sample_lexica(seed=0), target_error=0.01, display_progress=False), \
+            "Sampled listener at temperature %s didn't reach its target error" % temperature
+        assert np.all(np.abs(mod.final_listener - exact.final_listener) <= 5 * mod.standard_error + TOLERANCE), \
+            "Sampled listener at temperature %s is off by more than 5 standard errors" % temperature
+
+######################################################################
+
+if __name__ == '__main__':
+
+    test_unconstrained()
+    test_neo_gricean()
+    test_sampled()
+    print "All listeners finite and in agreement"
@@ -71,8 +71,13 @@ CONDITIONS = ("NNN", "NNS", "NNA", "NAA", "NSS", "NSA", "SSS", "SSA", "SAA", "AA
 # Utility functions
 
 def rownorm(mat):
-    """Row normalization of a matrix"""
-    return np.divide(mat.T, np.sum(mat, axis=1)).T
+    """Row normalization of a matrix, or of every matrix in a stack
+    of shape (batch, rows, cols)"""
+    return np.divide(mat, np.sum(mat, axis=-1)[..., np.newaxis])
+
+def transpose(mat):
+    """Transposition of a matrix, or of every matrix in a stack"""
+    return np.swapaxes(mat, -1, -2)
     
 def colnorm(mat):
     """Column normalization of a matrix"""    
@@ -82,6 +87,41 @@ def safelog(vals):
     with np.errstate(divide='ignore'):
         return np.log(vals)
 
+def expnorm(logmat, out=None, work=None):
+    """Row normalization of exp(logmat), for a matrix or a stack. This is
+    just rownorm(np.exp(logmat)), with identical results, except in rows
+    whose exponentials would all underflow to 0 or whose sum would
+    overflow: those are shifted by their maximum first, so they don't come
+    out nan. out may be logmat itself, and work an (..., 1) buffer for
+    the shifts."""
+    shift = np.max(logmat, axis=-1, keepdims=True, out=work)
+    with np.errstate(under='ignore'):
+        unshifted = (np.exp(shift) > 0.0) & (shift < np.log(np.finfo(float).max / logmat.shape[-1]))
+    # Rows that are all -inf come out nan, as zero rows do from rownorm:
+    shift[unshifted | np.isinf(shift)] = 0.0
+    out = np.subtract(logmat, shift, out=out)
+    np.exp(out, out=out)
+    out /= np.sum(out, axis=-1, keepdims=True, out=shift)
+    return out
+
+def lognorm(logmat, out=None):
+    """Row normalization in the log domain: logmat minus the logsumexp of
+    each row, computed with each row shifted by its maximum. out may be
+    logmat itself."""
+    shift = np.max(logmat, axis=-1, keepdims=True)
+    # Rows that are all -inf come out nan, as zero rows do from rownorm:
+    shift[np.isinf(shift)] = 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = np.log(np.sum(np.exp(logmat - shift), axis=-1, keepdims=True)) + shift
+        return np.subtract(logmat, total, out=out)
+
+def logsumexp(logmat, axis=0):
+    """log(np.sum(np.exp(logmat), axis=axis)), shifted like lognorm."""
+    shift = np.max(logmat, axis=axis, keepdims=True)
+    shift[np.isinf(shift)] = 0.0
+    with np.errstate(divide='ignore'):
+        return np.log(np.sum(np.exp(logmat - shift), axis=axis)) + np.squeeze(shift, axis=axis)
+
 def display_matrix(mat, display=True, rnames=None, cnames=None, title='', digits=4):
     """Utility function for displaying strategies to standard output.
     The display parameter saves a lot of conditionals in the important code"""
@@ -105,6 +145,15 @@ def powerset(x, minsize=0, maxsize=None):
             result.append(list(val))
     return result
 
+def batches(iterable, size):
+    """Yields the elements of iterable in lists of at most size elements."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
 def mse(x, y):
     err = np.sqrt(np.sum((x-y)**2)/len(x))
     return err